@@ -1,12 +1,15 @@
+import tempfile
+import threading
+from pathlib import Path
+
 import requests
-import io
-from urllib3.exceptions import MaxRetryError
 
 import geopandas as gpd
-from shapely.geometry import box
+from pyproj import Transformer
 
 from core_components.logger import setup_logger
 from core_components.config import get_config
+from core_components.api.session import SESSION, TIMEOUT
 
 logger = setup_logger(__name__)
 cfg = get_config()
@@ -14,9 +17,17 @@ cfg = get_config()
 URL = cfg["buildings"]["url"]
 COLS = cfg["buildings"]["columns"]
 FILTER = cfg["buildings"]["query_filter"]
+OUTPUT_FORMATS = cfg["buildings"]["output_formats"]
+# file suffixes so GDAL picks the driver of each output format
+OUTPUT_SUFFIXES = {"application/flatgeobuf": ".fgb", "application/json": ".geojson",
+                   "application/gml+xml; version=3.2": ".gml"}
 CRS = cfg["global"]["crs_default"]
 CRS_MAP = cfg["global"]["crs_map"]
 
+_TRANSFORMER = Transformer.from_crs(CRS, CRS_MAP, always_xy=True)
+_OUTPUT_FORMAT = None  # first output format the server accepted, tried first on the next calls
+_OUTPUT_FORMAT_LOCK = threading.Lock()
+
 
 def check_api_status() -> bool:
     """
@@ -26,11 +37,11 @@ def check_api_status() -> bool:
         bool: True if the API is up and running, False otherwise
     """
     try:
-        response = requests.get(URL, timeout=5,
+        response = SESSION.get(URL, timeout=TIMEOUT,
                                 params={"service":"WFS", 
                                         "request": "GetCapabilities"})
     
-    except (requests.exceptions.ReadTimeout, MaxRetryError):
+    except requests.exceptions.RequestException:
         return False
     return response.status_code == 200
 
@@ -46,11 +57,7 @@ def get_building_points(bounds:tuple) -> gpd.GeoDataFrame:
         gdf: GeoDataFrame with the building points
     """
 
-    gdf = gpd.GeoDataFrame([1], geometry=[box(*bounds)], crs=CRS)
-    gdf = gdf.to_crs(CRS_MAP)
-
-    bbox_reprojected = gdf.total_bounds
-    xmin, ymin, xmax, ymax = bbox_reprojected 
+    xmin, ymin, xmax, ymax = _TRANSFORMER.transform_bounds(*bounds)
     
     params = {
         "request": "GetFeature",
@@ -60,26 +67,58 @@ def get_building_points(bounds:tuple) -> gpd.GeoDataFrame:
         "srsname": "EPSG:25833",
         "bbox": f"{ymin},{xmin},{ymax},{xmax}"
     }
-    response = requests.get(URL, params=params)
     
+    global _OUTPUT_FORMAT
     dataset = gpd.GeoDataFrame(geometry=[], crs=CRS)
 
-    if response.status_code == 200:
-        content = response.content
-    else:
-        return dataset
-        
-    try:
-        file_like_object = io.BytesIO(content)
-        dataset = gpd.read_file(file_like_object, engine="fiona")
-        dataset = _format_dataset(dataset)
-    except Exception:
-        # print(e)
-        return dataset
+    # binary/json formats skip the GML parse; fall back to GML if the server rejects them.
+    # the order is built locally from a snapshot of the remembered format, concurrent calls only share _OUTPUT_FORMAT
+    with _OUTPUT_FORMAT_LOCK:
+        preferred_format = _OUTPUT_FORMAT
+    output_formats = sorted(OUTPUT_FORMATS, key=lambda output_format: output_format != preferred_format)
+    # the response is streamed to a temporary file and read from its path, so it is never held in memory whole
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for output_format in output_formats:
+            file_path = Path(tmp_dir) / ("features" + OUTPUT_SUFFIXES.get(output_format, ""))
+            if _download_features(params | {"outputFormat": output_format}, file_path):
+                with _OUTPUT_FORMAT_LOCK:
+                    _OUTPUT_FORMAT = output_format
+                break
+        else:
+            return dataset
+            
+        try:
+            dataset = gpd.read_file(file_path, engine="pyogrio")
+            dataset = _format_dataset(dataset)
+        except Exception:
+            # print(e)
+            return dataset
     
     return dataset
 
 
+def _download_features(params: dict, file_path: Path) -> bool:
+    """
+    Stream the WFS GetFeature response with the given parameters to a file, chunk by chunk
+
+    Args:
+        params: WFS request parameters
+        file_path: path of the file to write the response to
+
+    Returns:
+        bool: True if the features were written, False if the server returned an error
+    """
+    with SESSION.get(URL, params=params, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code != 200:
+            return False
+        with open(file_path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                file.write(chunk)
+
+    with open(file_path, "rb") as file:
+        return b"ExceptionReport" not in file.read(1000)
+
+
 def _format_dataset(dataset: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
     Slice and query the building points GeoDataFrame to keep only the relevant columns and rows
@@ -1,13 +1,15 @@
 import geopandas as gpd
-import requests
 import time
-from bs4 import BeautifulSoup
-import json
+import orjson
 
 from core_components.config import get_config
+from core_components.api.session import SESSION, TIMEOUT
 
 cfg = get_config()
 URL = cfg["consequence"]["url"]
+POLL_INITIAL_WAIT = cfg["consequence"]["poll_initial_wait"]
+POLL_MAX_WAIT = cfg["consequence"]["poll_max_wait"]
+POLL_TIMEOUT = cfg["consequence"]["poll_timeout"]
 
 
 def poly_to_esri(poly:gpd.GeoDataFrame) -> str:
@@ -23,7 +25,7 @@ def poly_to_esri(poly:gpd.GeoDataFrame) -> str:
         "rings": [geojson['coordinates'][0]],
         "spatialReference": {"wkid": poly.crs.to_epsg()}
     }
-    esri_geometry_string = json.dumps(esri_geometry)
+    esri_geometry_string = orjson.dumps(esri_geometry).decode()
     return esri_geometry_string
 
 
@@ -38,9 +40,9 @@ def check_job_status(job_id:str) -> dict:
     job_status_url = f"{URL}/jobs/{job_id}"
 
     status_url = f"{job_status_url}?f=json"
-    response = requests.get(status_url)
+    response = SESSION.get(status_url, timeout=TIMEOUT)
     if response.status_code == 200:
-        job_status = response.json()
+        job_status = orjson.loads(response.content)
         return job_status
     else:
         print(response.status_code)
@@ -57,20 +59,17 @@ def request_consequence_nve(polygon:gpd.GeoDataFrame, items:tuple=("Beboere","Ba
     """   
     gstring = poly_to_esri(polygon)
     
-    consequence_items_str = '['
-    for item in items:
-        consequence_items_str += f'"{item}",'
-    consequence_items_str = consequence_items_str[:-1] + ']'
+    consequence_items_str = orjson.dumps(list(items)).decode()
     # print(consequence_items_str)
     params = {
         'f': 'json',  
         'in_polygon': gstring,
         'Konsekvens_typer': consequence_items_str
         } 
-    response = requests.post(f"{URL}/submitJob", data=params)
+    response = SESSION.post(f"{URL}/submitJob", data=params, timeout=TIMEOUT)
     
     if response.status_code == 200:
-        job_info = response.json()
+        job_info = orjson.loads(response.content)
         job_id = job_info['jobId']
         # print("job id: ", job_id)
     else:
@@ -81,6 +80,8 @@ def request_consequence_nve(polygon:gpd.GeoDataFrame, items:tuple=("Beboere","Ba
     if job_id:
         job_status_url = f"{URL}/jobs/{job_id}"
         # print("job status url: ", job_status_url)
+        wait_time = POLL_INITIAL_WAIT
+        start_time = time.monotonic()
         while True:
             response_json = check_job_status(job_id)
             status = response_json["jobStatus"]
@@ -88,31 +89,95 @@ def request_consequence_nve(polygon:gpd.GeoDataFrame, items:tuple=("Beboere","Ba
 
             if status in ['esriJobSucceeded', 'esriJobFailed']:
                 break
-            time.sleep(30) 
+            if time.monotonic() - start_time > POLL_TIMEOUT:
+                return {"API error": f"job not finished after {POLL_TIMEOUT} s, see the details here: {job_status_url}"}
+            time.sleep(wait_time)
+            wait_time = min(POLL_MAX_WAIT, wait_time * 1.5)
     
     if status == 'esriJobSucceeded':
         result_url = f"{job_status_url}/results/resultat"
         print("result url: ", result_url)
-        response = requests.get(result_url)
+        response = SESSION.get(result_url, params={"f": "json"}, timeout=TIMEOUT)
         if response.status_code != 200:
             return {"error: ", response.status_code}
             
         else:
-            html_content = response.content
-            soup = BeautifulSoup(html_content, 'html.parser')
-            body = soup.body
+            data_dict = orjson.loads(response.content)
+            value = data_dict["value"]
+            # GPString results come back as a serialized json string
+            if isinstance(value, str):
+                value = orjson.loads(value)
             
-            td_pre_tags = soup.find_all('td')
-            for td in td_pre_tags:
-                pre_tag = td.find('pre')
-                if pre_tag:
-                    text_inside_pre = pre_tag.get_text()
-                    data_dict = json.loads(text_inside_pre)
-            
-            return data_dict["value"]["konsekvensparametere"]
+            return _fix_encoding(value["konsekvensparametere"])
     else:
         return {"API error": f"see the details here: {job_status_url}"}
 
+def _fix_encoding(value):
+    """
+    Repair the Avviksmelding messages of the consequence results (at every level), the only field that comes
+    as utf-8 text decoded as latin1 (mojibake). The other values are kept as they are.
+    Args:
+        value: dict or any other value from the consequence results
+    Returns:
+        the same structure with the Avviksmelding messages repaired
+    """
+    if not isinstance(value, dict):
+        return value
+    fixed = {kk: _fix_encoding(vv) for kk, vv in value.items()}
+    message = fixed.get("Avviksmelding")
+    if isinstance(message, str):
+        try:
+            fixed["Avviksmelding"] = message.encode('latin1').decode('utf-8')
+        except UnicodeError:
+            pass
+    return fixed
+
+
+QUERY_ITEMS = frozenset(["beboere", "barnehagebarn", "skoleelever", "ansatte", "bygninger", "veier", "kraftnett", "toglinjer"])
+
+HTML_HEADER = """<html>
+<head>
+
+        <style>
+            body {
+                font-family: Arial, sans-serif;
+                line-height: 0.8;
+                margin: 20px;
+            }
+
+            h2.consequence-popup {
+                font-size: 1em;
+                color: #333;
+                line-height: 1.5;
+            }
+            h3.consequence-popup {
+                font-size: 0.9em;
+                color: #333;
+                line-height: 1.5;
+            }
+            h4.consequence-popup {
+                font-size: 0.8em;
+                color: #333;
+                line-height: 1.5;
+            }
+            p.consequence-popup {
+                font-size: 0.7em;
+                color: #666;
+                margin: 0px;
+            }
+            hr.consequence-popup {
+                border: 0;
+                height: 1px;
+                background: #ccc;
+                margin: 2px 0;
+            }
+        </style>
+        
+</head>
+<body>"""
+HTML_FOOTER = "</body>\n</html>"
+
+
 def report_consequence(consequence_dict: dict) -> list:
     """
     Report the consequences from the NVE API
@@ -123,19 +188,15 @@ def report_consequence(consequence_dict: dict) -> list:
     """
 
     output = []
-    query_items = ["beboere","barnehagebarn", "skoleelever","ansatte","bygninger","veier","kraftnett","toglinjer"]
     for kk, vv in consequence_dict.items():
-        if kk in query_items: output.append("\n")
+        if kk in QUERY_ITEMS: output.append("\n")
         if kk != "Avviksmelding": output.append(kk)
-        if kk in query_items: output.append("--------------------")
+        if kk in QUERY_ITEMS: output.append("--------------------")
         if isinstance(vv, dict):
-            oo = report_consequence(vv)
-            
-            if len(oo) > 0:
-                output.extend(oo)
+            output += report_consequence(vv)
                 
             if 'Avviksmelding' in vv.keys() and vv['Avviksmelding'] != "Ingen":
-                output.append(f"  {vv['Avviksmelding'].encode('latin1').decode('utf-8')}")
+                output.append(f"  {vv['Avviksmelding']}")
             
         else:
             if kk != "Avviksmelding": 
@@ -172,73 +233,40 @@ def report_consequence_html(consequence_dict:dict, level:int=2) -> list:
         list: list with the report
     """
     output = []
-    query_items = ["beboere", "barnehagebarn", "skoleelever", "ansatte", "bygninger", "veier", "kraftnett", "toglinjer"]
-    
-    if level == 2:
-        output.append("<html>")
-        output.append("<head>")
-        output.append("""
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                line-height: 0.8;
-                margin: 20px;
-            }
+    _write_consequence_html(consequence_dict, output.append, level)
+    return output
 
-            h2.consequence-popup {
-                font-size: 1em;
-                color: #333;
-                line-height: 1.5;
-            }
-            h3.consequence-popup {
-                font-size: 0.9em;
-                color: #333;
-                line-height: 1.5;
-            }
-            h4.consequence-popup {
-                font-size: 0.8em;
-                color: #333;
-                line-height: 1.5;
-            }
-            p.consequence-popup {
-                font-size: 0.7em;
-                color: #666;
-                margin: 0px;
-            }
-            hr.consequence-popup {
-                border: 0;
-                height: 1px;
-                background: #ccc;
-                margin: 2px 0;
-            }
-        </style>
-        """)
-        output.append("</head>")
-        output.append("<body>")
+
+def _write_consequence_html(consequence_dict:dict, write, level:int=2) -> None:
+    """
+    Write the consequences from the NVE API as html elements, one call to write per element
+    Args:
+        consequence_dict: dict with the consequence parameters
+        write: callable receiving each html element as a string
+        level: int with the level of the header
+    Returns:
+        None
+    """
+    if level == 2:
+        write(HTML_HEADER)
     
     for kk, vv in consequence_dict.items():
-        if kk in query_items:
-            output.append("<br>")
+        if kk in QUERY_ITEMS:
+            write("<br>")
         if kk != "Avviksmelding":
-            output.append(f"<h{level} class=consequence-popup>{format_dict.get(kk, kk)}</h{level}>")
-        if kk in query_items:
-            output.append("<hr class=consequence-popup>")
+            write(f"<h{level} class=consequence-popup>{format_dict.get(kk, kk)}</h{level}>")
+        if kk in QUERY_ITEMS:
+            write("<hr class=consequence-popup>")
         if isinstance(vv, dict):
-            oo = report_consequence_html(vv, level + 1)
-            if len(oo) > 0:
-                output.extend(oo)
+            _write_consequence_html(vv, write, level + 1)
             if 'Avviksmelding' in vv.keys() and vv['Avviksmelding'] != "Ingen":
-                output.append(f"<p class=consequence-popup>({vv['Avviksmelding'].encode('latin1').decode('utf-8')})</p>")
-            #     continue
+                write(f"<p class=consequence-popup>({vv['Avviksmelding']})</p>")
         else:
             if kk != "Avviksmelding":
-                output.append(f"<p class=consequence-popup>{vv}</p>")
+                write(f"<p class=consequence-popup>{vv}</p>")
     
     if level == 2:
-        output.append("</body>")
-        output.append("</html>")
-    
-    return output
+        write(HTML_FOOTER)
 
 
 def generate_html(consequence_dict:dict) -> str:
@@ -249,7 +277,6 @@ def generate_html(consequence_dict:dict) -> str:
     Returns:
         str: html string
     """
-    html_lines = report_consequence_html(consequence_dict)
-    return "\n".join(html_lines)
+    return "\n".join(report_consequence_html(consequence_dict))
 
 
@@ -1,18 +1,31 @@
+import hashlib
 import time
-from urllib.request import urlopen
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from pathlib import Path
 
 import numpy as np
 import rasterio
+import requests
 from rasterio import MemoryFile
 
 from core_components.config import get_config
 from core_components.logger import setup_logger
+from core_components.api.session import SESSION, TIMEOUT
 
 logger = setup_logger(__name__)
 cfg = get_config()
 
 HOYDEDATA_LAYER = cfg["hoydedata"]["hoydedata_layer"]
 HOYDEDATA_URL = cfg["hoydedata"]["hoydedata_url"]
+MAX_WORKERS = cfg["hoydedata"]["max_workers"]
+CACHE_DIR = Path(cfg["hoydedata"]["cache_dir"]).expanduser()
+CACHE_SIZE = cfg["hoydedata"]["cache_size"]
+SAMPLE_DENSITY_THRESHOLD = cfg["hoydedata"]["sample_density_threshold"]
+CACHE_EXPIRE = cfg["hoydedata"]["cache_expire"]
+CACHE_MAX_FILES = cfg["hoydedata"]["cache_max_files"]
+TIFF_MAGIC = (b"II*\x00", b"MM\x00*")
 CRS = cfg["global"]["crs_default"]  # default crs
 
 
@@ -26,22 +39,15 @@ def check_api_status():
     xmin, ymin, xmax, ymax, width, height, nodata = 261906, 6650936, 264220, 6651626, 462, 138, -9999
     request_url = HOYDEDATA_URL.format(HOYDEDATA_LAYER, xmin, ymin, xmax, ymax, width, height, nodata)
 
-
-    attempts = 0
-    wait_time = 1
-    while attempts < 10:
-        try:
-            _ = urlopen(request_url).read()
-            break
-        except Exception:
-            attempts += 1
-            time.sleep(wait_time)
-    else:
+    try:
+        response = SESSION.get(request_url, timeout=TIMEOUT)
+    except requests.exceptions.RequestException:
         return False
-    return True
+    return response.status_code == 200
 
 
-def request_hoydedata(bounds:tuple, res:int=5, nodata:int=-9999, max_retries:int=5) -> bytes:
+def request_hoydedata(bounds:tuple, res:int=5, nodata:int=-9999, max_retries:int=None, 
+                      use_cache:bool=True) -> bytes:
     """
     Get the digital elevation model from the given bounds from the høydedata API
 
@@ -49,11 +55,16 @@ def request_hoydedata(bounds:tuple, res:int=5, nodata:int=-9999, max_retries:int
         bounds: tuple with the bounding box (xmin, ymin, xmax, ymax)
         res: resolution of the raster
         nodata: nodata value
-        max_retries: maximum number of retries
+        max_retries: deprecated and ignored, the retries are configured in the http settings (SESSION)
+        use_cache: read/write the tif from/to the disk cache in CACHE_DIR (kept for CACHE_EXPIRE seconds)
 
     Returns:
         tif_bytes: bytes of the tif file
     """
+    if max_retries is not None:
+        warnings.warn("max_retries is ignored, the retries are configured in config['http']['max_retries']",
+                      DeprecationWarning, stacklevel=2)
+
     xmin, ymin, xmax, ymax = bounds
     xmin -= 10
     xmax += 10
@@ -66,24 +77,66 @@ def request_hoydedata(bounds:tuple, res:int=5, nodata:int=-9999, max_retries:int
 
     request_url = HOYDEDATA_URL.format(HOYDEDATA_LAYER, xmin, ymin, xmax, ymax, width, height, nodata)
 
-    attempts = 0
-    wait_time = 1
-    while attempts < max_retries:
+    cache_file = CACHE_DIR / f"{hashlib.blake2b(request_url.encode(), digest_size=16).hexdigest()}.tif"
+    if use_cache:
         try:
-            tif_bytes = urlopen(request_url).read()
-            break
-        except Exception:
-            attempts += 1
-            time.sleep(wait_time)
-    else:
-        print(request_url)
-        raise Exception("Error (Probably area requested is too big/small or høydedata is down)")
+            if time.time() - cache_file.stat().st_mtime <= CACHE_EXPIRE:
+                return cache_file.read_bytes()
+        except OSError:
+            pass
+
+    # retries with backoff are handled by the SESSION adapter
+    try:
+        response = SESSION.get(request_url, timeout=TIMEOUT)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        raise Exception("Error (Probably area requested is too big/small or høydedata is down)") from e
+    tif_bytes = response.content
+
+    # error messages can come back with status 200, only actual tiffs are cached
+    if use_cache and tif_bytes[:4] in TIFF_MAGIC:
+        _cache_set(cache_file, tif_bytes)
     return tif_bytes
 
 
+def _cache_set(cache_file: Path, tif_bytes: bytes):
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(".tmp")
+        tmp_file.write_bytes(tif_bytes)
+        tmp_file.replace(cache_file)
+
+        cached_files = list(CACHE_DIR.glob("*.tif"))
+        if len(cached_files) > CACHE_MAX_FILES:
+            cached_files.sort(key=lambda file: file.stat().st_mtime)
+            for file in cached_files[:len(cached_files) - CACHE_MAX_FILES]:
+                file.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not write the hoydedata cache: {e}")
+
+
+def request_hoydedata_many(bounds_list:list, res:int=5, nodata:int=-9999) -> list:
+    """
+    Get the digital elevation models for several bounding boxes concurrently from the høydedata API
+
+    Args:
+        bounds_list: list of tuples with the bounding boxes (xmin, ymin, xmax, ymax)
+        res: resolution of the rasters
+        nodata: nodata value
+
+    Returns:
+        tif_bytes_list: list with the bytes of the tif files, in the same order as bounds_list
+    """
+    request = partial(request_hoydedata, res=res, nodata=nodata)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        tif_bytes_list = list(executor.map(request, bounds_list))
+    return tif_bytes_list
+
+
+@lru_cache(maxsize=CACHE_SIZE)
 def generate_raster_from_hoydedata(tif_bytes:bytes) -> tuple:
     """
-    Generate a raster from the given tif bytes
+    Generate a raster from the given tif bytes. Results are cached, so the returned array is read-only.
 
     Args:
         tif_bytes: bytes of the tif file
@@ -96,6 +149,7 @@ def generate_raster_from_hoydedata(tif_bytes:bytes) -> tuple:
         with MemoryFile(tif_bytes) as memfile:
             with memfile.open() as dataset:
                 dem_array = dataset.read(1)
+                dem_array.flags.writeable = False
                 dataset_profile = dataset.profile
 
     except rasterio.errors.RasterioIOError as e:
@@ -114,19 +168,69 @@ def get_z_from_hoydedata(point_array: np.ndarray, res=5) -> np.ndarray:
     Returns: numpy array with x,y,z coordinates
 
     """
-    if point_array.shape == (2,):
-        points_xy = np.expand_dims(point_array,0)
-    else:
-        points_xy = point_array.copy()
+    points_xy = np.atleast_2d(point_array)
     xmin, ymin = points_xy.min(axis=0)
     xmax, ymax = points_xy.max(axis=0)
 
     
     tif_bytes = request_hoydedata((xmin,ymin,xmax,ymax), res=res)
+    z = sample_points_from_hoydedata(tif_bytes, points_xy)
+
+    return z
+
+
+def sample_points_from_hoydedata(tif_bytes:bytes, points_xy:np.ndarray) -> np.ndarray:
+    """
+    Sample the elevation values at the given points from the given tif bytes.
+    Sparse point sets (fewer than SAMPLE_DENSITY_THRESHOLD points per pixel) are read with windowed reads
+    (dataset.sample) instead of loading the whole raster, denser point sets read the full (cached) raster once
+    and index it.
+
+    Args:
+        tif_bytes: bytes of the tif file
+        points_xy: numpy array with the x,y coordinates to the points, shape (n, 2)
+
+    Returns:
+        z: numpy array with the elevation values
+    """
+    with MemoryFile(tif_bytes) as memfile:
+        with memfile.open() as dataset:
+            if len(points_xy) < SAMPLE_DENSITY_THRESHOLD * dataset.width * dataset.height:
+                return np.fromiter((value[0] for value in dataset.sample(points_xy, indexes=1)),
+                                   dtype=dataset.dtypes[0], count=len(points_xy))
+
     dem_array, profile = generate_raster_from_hoydedata(tif_bytes)
-    transform = profile["transform"]
+    rows, cols = rowcol_from_transform(profile["transform"], points_xy[:, 0], points_xy[:, 1])
+    return dem_array[rows, cols]
 
-    index = np.array([rasterio.transform.rowcol(transform, xx[0], xx[1]) for xx in points_xy])
-    z = np.array([dem_array[xx[0], xx[1]] for xx in index])
 
-    return z
+def rowcol_from_transform(transform, xs: np.ndarray, ys: np.ndarray) -> tuple:
+    """
+    Vectorized equivalent of rasterio.transform.rowcol: pixel indices for arrays of x,y coordinates
+
+    Args:
+        transform: affine transform of the raster
+        xs: numpy array with the x coordinates
+        ys: numpy array with the y coordinates
+
+    Returns:
+        rows: numpy array with the row indices
+        cols: numpy array with the column indices
+    """
+    inv = ~transform
+    cols = _affine_floor(xs, ys, inv.a, inv.b, inv.c)
+    rows = _affine_floor(xs, ys, inv.d, inv.e, inv.f)
+    return rows, cols
+
+
+def _affine_floor(xs: np.ndarray, ys: np.ndarray, a: float, b: float, c: float) -> np.ndarray:
+    """
+    floor(a*xs + b*ys + c) as integer indices, computed in place in a single float buffer.
+    The b term is skipped for north-up rasters, where it is always zero.
+    """
+    out = np.multiply(xs, a, dtype=np.float64)
+    if b:
+        out += np.multiply(ys, b)
+    out += c
+    np.floor(out, out=out)
+    return out.astype(np.intp)
@@ -1,14 +1,26 @@
+import re
 import numpy as np
 import requests
 import asyncio
+import hashlib
+import os
+import time
 import httpx
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
 
 import geopandas as gpd
 import pandas as pd
+import shapely
+from pyproj import Transformer
 from shapely.geometry import box
 
 from core_components.config import get_config
 from core_components.logger import setup_logger
+from core_components.api.session import SESSION, TIMEOUT as HTTP_TIMEOUT
 
 
 logger = setup_logger(__name__)
@@ -22,23 +34,55 @@ COLUMN_MAPPER_BH = cfg["nadag"]["column_mapper_borehole"]
 COLUMN_MAPPER_SA = cfg["nadag"]["column_mapper_samples"]
 SAMPLE_COLUMNS = cfg["nadag"]["columns_samples"]
 TIMEOUT = cfg["nadag"]["timeout"]
+MAX_CONNECTIONS = cfg["nadag"]["max_connections"]
+MAX_KEEPALIVE_CONNECTIONS = cfg["nadag"]["max_keepalive_connections"]
+KEEPALIVE_EXPIRY = cfg["nadag"]["keepalive_expiry"]
+CONNECT_RETRIES = cfg["nadag"]["connect_retries"]
+MAX_CONCURRENCY = cfg["nadag"]["max_concurrency"]
+MAX_CONCURRENT_REQUESTS = cfg["nadag"]["max_concurrent_requests"]
+CACHE_DIR = Path(cfg["nadag"]["cache_dir"]).expanduser()
+CACHE_EXPIRE = cfg["nadag"]["cache_expire"]
+CACHE_SIZE = cfg["nadag"]["cache_size"]
+CACHE_MAX_FILES = cfg["nadag"]["cache_max_files"]
+CACHE_PRUNE_INTERVAL = 1000  # disk cache writes between two prunes
 QCL_KWD = ["quick", "kvikk", "sprøbrudd"]
+QCL_RE = re.compile("|".join(map(re.escape, QCL_KWD)), re.IGNORECASE)
+LAYER_COMPOSITION_LABELS = ("nothing", "other", "quick_clay")  # in increasing rank
+NON_NUMERIC_COLUMNS_BH = ("method_id", "comment_code", "comment")
+NUMERIC_COLUMNS_BH = tuple(col for col in COLUMN_MAPPER_BH.values() if col not in NON_NUMERIC_COLUMNS_BH)
+NUMERIC_COLUMNS_SA = ("depth_top", "depth_base", "strength_undisturbed", "strength_undrained", "strength_remoulded",
+                      "liquid_limit", "plastic_limit", "water_content", "location_elevation")
+# one precompiled alternation per flag column, matching any of its codes as a substring
+FLAG_CODE_RES = {col: re.compile("|".join(map(re.escape, map(str, codes)))) for col, codes in cfg["nadag"]["flag_codes"].items()}
 
-# collections = requests.get(base_url).json()
-# valid_crs = {int(xx.split("/")[-1]):xx for xx in collections["crs"] if xx.split("/")[-1].isnumeric()}
-# valid_collections = [xx["id"] for xx in collections["collections"]]
+_BBOX_TRANSFORMER = Transformer.from_crs(CRS, CRS_API, always_xy=True)
 
 
 def check_api_status():
     try:
+        # one-shot probe without the SESSION retries, so an unreachable API falls back to the built-in lists quickly
         response = requests.get(base_url, timeout=5)
-    except requests.exceptions.ReadTimeout:
+    except requests.exceptions.RequestException:
         return False
     return response.status_code == 200
 
 
+@lru_cache(maxsize=1)
 def get_api_data():
-    if not check_api_status():
+    """
+    Get the collections and crs supported by the NADAG API. The response is cached on disk for CACHE_EXPIRE
+    seconds, and a built-in list is used if the API cannot be reached or the NADAG_OFFLINE environment
+    variable is set (e.g. for tests/CI).
+    Returns:
+        tuple: list of valid collections, dict of valid crs (epsg code: crs uri)
+    """
+    collections = _read_api_meta()
+    if collections is None and not os.environ.get("NADAG_OFFLINE") and check_api_status():
+        content = SESSION.get(base_url, timeout=HTTP_TIMEOUT).content
+        collections = orjson.loads(content)
+        _write_api_meta(content)
+
+    if collections is None:
         valid_collections = [
             'deformasjonmaling',
             'dynamisksondering',
@@ -74,99 +118,306 @@ def get_api_data():
             3857: 'http://www.opengis.net/def/crs/EPSG/0/3857',
             4326: 'http://www.opengis.net/def/crs/EPSG/0/4326'}
     else:
-        collections = requests.get(base_url).json()
         valid_crs = {int(xx.split("/")[-1]):xx for xx in collections["crs"] if xx.split("/")[-1].isnumeric()}
         valid_collections = [xx["id"] for xx in collections["collections"]]
     return valid_collections, valid_crs
 
-valid_collections, valid_crs = get_api_data()
+
+def _read_api_meta() -> dict:
+    api_meta_file = CACHE_DIR / "api_meta.json"
+    try:
+        if time.time() - api_meta_file.stat().st_mtime > CACHE_EXPIRE:
+            return None
+        collections = orjson.loads(api_meta_file.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    # an incomplete file is treated as missing, so the API (or the built-in lists) is used instead
+    if not isinstance(collections, dict) or not {"crs", "collections"} <= collections.keys():
+        return None
+    return collections
+
+
+def _write_api_meta(content: bytes):
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        (CACHE_DIR / "api_meta.json").write_bytes(content)
+    except OSError as e:
+        logger.warning(f"Could not write the NADAG cache: {e}")
+
+
+def __getattr__(name):
+    # valid_collections/valid_crs are resolved on first access, the API is not probed at import time
+    if name == "valid_collections":
+        return get_api_data()[0]
+    if name == "valid_crs":
+        return get_api_data()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_href(href):
-    response = requests.get(href)
+    response = SESSION.get(href, timeout=HTTP_TIMEOUT)
     response.raise_for_status()
-    data = response.json()
+    data = orjson.loads(response.content)
 
     if all([xx in data.keys() for xx in ('numberReturned', 'numberMatched')]):
         if data["numberReturned"] < data["numberMatched"]:
-            response = requests.get(href, params={'limit': data["numberMatched"]+1})
+            response = SESSION.get(href, params={'limit': data["numberMatched"]+1}, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
 
     return data
 
 
-async def get_async(href: str) -> dict:
+_CLIENT = None
+_CLIENT_LOOP = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """
+    Shared AsyncClient (keep-alive pool, HTTP/2) for the NADAG fetches.
+    It is created on first use and recreated if the running event loop changes,
+    since a client cannot be reused across event loops.
+    """
+    global _CLIENT, _CLIENT_LOOP
+    loop = asyncio.get_running_loop()
+    if _CLIENT is None or _CLIENT_LOOP is not loop:
+        _CLIENT = _new_client()
+        _CLIENT_LOOP = loop
+    return _CLIENT
+
+
+def _new_client() -> httpx.AsyncClient:
+    # the limits and http2 go on the transport, which the client does not configure when one is given.
+    # httpx already asks for gzip/deflate (and br when brotli is installed)
+    transport = httpx.AsyncHTTPTransport(retries=CONNECT_RETRIES,
+                                         http2=True,
+                                         limits=httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                                             max_connections=MAX_CONNECTIONS,
+                                                             keepalive_expiry=KEEPALIVE_EXPIRY))
+    return httpx.AsyncClient(timeout=httpx.Timeout(TIMEOUT), transport=transport)
+
+
+async def aclose() -> None:
+    """
+    Close the shared AsyncClient and its connections
+    """
+    global _CLIENT, _CLIENT_LOOP
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+    _CLIENT = None
+    _CLIENT_LOOP = None
+
+
+async def get_async(href: str, client: httpx.AsyncClient = None, bypass_cache: bool = False) -> dict:
+    """
+    Fetch a NADAG href as json. Responses are cached in memory and on disk (CACHE_DIR) for CACHE_EXPIRE seconds,
+    keyed by the url. The returned dicts are shared with the cache and must not be modified.
+    Args:
+        href (str): url to fetch
+        client (httpx.AsyncClient, optional): Client to use. Defaults to the shared client.
+        bypass_cache (bool, optional): Skip the cache lookup (the response is still stored). Defaults to False.
+    Returns:
+        dict: the json response, or None if href is None
+    """
     if href is None:
         return None
-    timeout = httpx.Timeout(TIMEOUT)
-    async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.get(href) 
-            data = response.json()
+    if not bypass_cache:
+        data = _cache_get(href)
+        if data is not None:
+            return data
+
+        # coalesce concurrent requests for the same href into the one already in flight
+        task = _IN_FLIGHT.get(href)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            return await asyncio.shield(task)
 
-            if all([xx in data.keys() for xx in ('numberReturned', 'numberMatched')]):
-                if data["numberReturned"] < data["numberMatched"]:
-                    response = await client.get(href, params={'limit': data["numberMatched"]+1}) 
-                    data = response.json()
+    if client is None:
+        client = _get_client()
 
+    task = asyncio.ensure_future(_fetch_href(href, client))
+    _IN_FLIGHT[href] = task
+    try:
+        return await asyncio.shield(task)
+    finally:
+        if _IN_FLIGHT.get(href) is task:
+            del _IN_FLIGHT[href]
+
+
+async def _fetch_href(href: str, client: httpx.AsyncClient) -> dict:
+    # error responses raise here, so they never reach the cache
+    response = await client.get(href) 
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+
+    if all([xx in data.keys() for xx in ('numberReturned', 'numberMatched')]):
+        if data["numberReturned"] < data["numberMatched"]:
+            response = await client.get(httpx.URL(href).copy_merge_params({'limit': data["numberMatched"]+1}))
+            response.raise_for_status()
+            data = orjson.loads(response.content)
+
+    _cache_set(href, data, response.content)
     return data
 
 
-async def get_href_list(href_list):
-    return await asyncio.gather(*[get_async(href) for href in href_list])
+async def get_href_list(href_list, client: httpx.AsyncClient = None, bypass_cache: bool = False):
+    """
+    Fetch a list of NADAG hrefs concurrently (see get_async). Pages that fail are logged and returned as None,
+    like missing hrefs, so one failing page does not fail the whole list.
+    Args:
+        href_list (list): urls to fetch, None entries give None
+        client (httpx.AsyncClient, optional): Client to use. Defaults to the shared client.
+        bypass_cache (bool, optional): Skip the cache lookup. Defaults to False.
+    Returns:
+        list: the json responses (shared with the cache, must not be modified), in the order of href_list
+    """
+    if client is None:
+        client = _get_client()
+    # identical hrefs are requested only once
+    unique_hrefs = list(dict.fromkeys(href_list))
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
+    async def get_bounded(href):
+        async with semaphore:
+            return await get_async(href, client, bypass_cache)
 
-async def get_soundings(soudings_href_list, method):
-    
-    sounding_type_dict = {"rp": "statiskSondering", 
-                          "tot": "kombinasjonSondering", 
-                          "cpt": "trykksondering", 
-                          "prv": "geotekniskProveserie"}
-    
-    assert method in sounding_type_dict.keys(), f"soundings_type must be one of {sounding_type_dict.keys()}"
+    results = await asyncio.gather(*[get_bounded(href) for href in unique_hrefs], return_exceptions=True)
+    for ii, result in enumerate(results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            logger.warning(f"Could not fetch {unique_hrefs[ii]}: {result!r}")
+            results[ii] = None
+    data = dict(zip(unique_hrefs, results))
+    return [data[href] for href in href_list]
+
+
+_HREF_CACHE = {}
+_IN_FLIGHT = {}
+_CACHE_WRITES = 0
+
+
+def _cache_file(href: str) -> Path:
+    return CACHE_DIR / f"{hashlib.blake2b(href.encode(), digest_size=16).hexdigest()}.json"
+
+
+def _cache_get(href: str) -> dict:
+    data = _HREF_CACHE.pop(href, None)
+    if data is not None:
+        # re-insert to keep the dict in least recently used order
+        _HREF_CACHE[href] = data
+        return data
+
+    cache_file = _cache_file(href)
+    try:
+        if time.time() - cache_file.stat().st_mtime > CACHE_EXPIRE:
+            return None
+        data = orjson.loads(cache_file.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    _cache_memory(href, data)
+    return data
+
+
+def _cache_set(href: str, data: dict, content: bytes):
+    _cache_memory(href, data)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cache_file = _cache_file(href)
+        tmp_file = cache_file.with_suffix(".tmp")
+        tmp_file.write_bytes(content)
+        tmp_file.replace(cache_file)
+    except OSError as e:
+        logger.warning(f"Could not write the NADAG cache: {e}")
+        return
+
+    global _CACHE_WRITES
+    # the first write of a session and every CACHE_PRUNE_INTERVAL-th write prune the disk cache
+    if _CACHE_WRITES % CACHE_PRUNE_INTERVAL == 0:
+        _cache_prune()
+    _CACHE_WRITES += 1
+
+
+def _cache_prune():
+    """
+    Remove the expired responses from the disk cache, and the oldest ones beyond CACHE_MAX_FILES
+    """
+    try:
+        with os.scandir(CACHE_DIR) as entries:
+            cached_files = [(entry.stat().st_mtime, entry.path) for entry in entries if entry.name.endswith(".json")]
+        cached_files.sort(reverse=True)
+        expired = time.time() - CACHE_EXPIRE
+        for ii, (mtime, path) in enumerate(cached_files):
+            if ii >= CACHE_MAX_FILES or mtime < expired:
+                os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not prune the NADAG cache: {e}")
 
+
+def _cache_memory(href: str, data: dict):
+    if len(_HREF_CACHE) >= CACHE_SIZE:
+        # dicts keep insertion order, drop the least recently used entry
+        del _HREF_CACHE[next(iter(_HREF_CACHE))]
+    _HREF_CACHE[href] = data
+
+
+SOUNDING_TYPES = {"rp": "statiskSondering", 
+                  "tot": "kombinasjonSondering", 
+                  "cpt": "trykksondering", 
+                  "prv": "geotekniskProveserie"}
+
+
+async def get_soundings(soudings_href_list, method):
     
-    soundings_type = sounding_type_dict[method]
+    assert method in SOUNDING_TYPES.keys(), f"soundings_type must be one of {SOUNDING_TYPES.keys()}"
 
     ksd_list = await get_href_list(soudings_href_list)
-    ksd_href_list = [xx["properties"][f"{soundings_type}Observasjon"]["href"] if xx is not None else None for xx in ksd_list]
-    ks_data = await get_href_list(ksd_href_list)
+    ks_data = await get_href_list(_observation_hrefs(ksd_list, method))
+    return _soundings_to_dataframes(ksd_list, ks_data, method)
 
-    ks_data_df = []
-    for ii, item in enumerate(ks_data):
-        if item is None: 
-            new_elem = pd.DataFrame(columns=COLUMN_MAPPER_BH.values())            
+
+def _observation_hrefs(ksd_list: list, method: str) -> list:
+    soundings_type = SOUNDING_TYPES[method]
+    return [xx["properties"][f"{soundings_type}Observasjon"]["href"] if xx is not None else None for xx in ksd_list]
+
+
+def _soundings_to_dataframes(ksd_list: list, ks_data: list, method: str) -> list:
+    # one frame for the observations of all soundings, split per sounding at the end
+    groups = [ii for ii, item in enumerate(ks_data) if item is not None for _ in item["features"]]
+    data = pd.DataFrame.from_records([feature["properties"] for item in ks_data if item is not None 
+                                      for feature in item["features"]])
+    data["__group"] = groups
+
+    if len(data) > 0:
+        if method == "cpt":
+            data["alpha"] = data["__group"].map({ii: ksd_list[ii]["properties"]["alpha"] for ii in set(groups)})
+        
+        if "observasjonKode" not in data.columns:
+            data["observasjonKode"] = None
         else:
-            features = item["features"]
-            properties = [ii["properties"] for ii in features]
-            data = pd.DataFrame.from_dict(properties)
-            if len(data) == 0:
-                new_elem = pd.DataFrame(columns=COLUMN_MAPPER_BH.values())
-            else:
-                if method == "cpt":
-                    data["alpha"] = ksd_list[ii]["properties"]["alpha"]
-                
-                try:
-                    if "observasjonKode" not in data.columns:
-                        data["observasjonKode"] = None
-                    data["observasjonKode"] = data.observasjonKode.replace(np.nan, None)
-                    data.columns = data.columns.str.lower()
-
-                    new_elem = (
-                        data.rename(columns=COLUMN_MAPPER_BH)
-                            .sort_values(by="depth")
-                            .reset_index(drop=True)
-                                )
-                except Exception as e:
-                    print(e)
-                    print(method)
-                    print(data.columns)
-                    print(len(data))
-                
-                if method == 'tot':
-                    new_elem[["hammering", "increased_rotation_rate", "flushing"]] = create_intervals_from_comments(new_elem)
-                else:
-                    new_elem[["hammering", "increased_rotation_rate", "flushing"]] = False
+            # missing codes as None
+            comment_codes = data["observasjonKode"].to_numpy(dtype=object)
+            data["observasjonKode"] = np.where(pd.isna(comment_codes), None, comment_codes)
+        data.columns = [col.lower() for col in data.columns]
+
+        data = (
+            data.rename(columns=COLUMN_MAPPER_BH)
+                .pipe(_to_float, NUMERIC_COLUMNS_BH)
+                .sort_values(by=["__group", "depth"], kind="stable")
+                    )
+        # flag intervals of all soundings in one pass, restarting at each sounding
+        if method == 'tot':
+            data[["hammering", "increased_rotation_rate", "flushing"]] = create_intervals_from_comments(
+                data, data["__group"].to_numpy())
+        else:
+            data[["hammering", "increased_rotation_rate", "flushing"]] = False
+    frames = dict(tuple(data.groupby("__group", sort=False))) if len(data) > 0 else {}
 
+    ks_data_df = []
+    for ii in range(len(ks_data)):
+        if ii not in frames:
+            new_elem = pd.DataFrame(columns=COLUMN_MAPPER_BH.values())
+            new_elem[["hammering", "increased_rotation_rate", "flushing"]] = False
+        else:
+            new_elem = frames[ii].drop(columns="__group").reset_index(drop=True)
 
         ks_data_df.append(new_elem)
     
@@ -182,87 +433,136 @@ async def get_all_soundings(borehullunders: gpd.GeoDataFrame) -> gpd.GeoDataFram
         gpd.GeoDataFrame or None: A GeoDataFrame containing processed borehole sounding data, or None if no data is available.
     """
 
-    gbhu = borehullunders.copy()
-    gbhu = gbhu.rename(columns={"metode-StatiskSondering": "ss",
-                                "metode-KombinasjonSondering": "ks",
-                                "metode-Trykksondering": "ts",
-                                "metode-GeotekniskPrøveserie": "ps",})
+    # rename returns a new frame, the column assignments below do not touch borehullunders
+    gbhu = borehullunders.rename(columns={"metode-StatiskSondering": "ss",
+                                          "metode-KombinasjonSondering": "ks",
+                                          "metode-Trykksondering": "ts",
+                                          "metode-GeotekniskPrøveserie": "ps",})
     for xx in ["ss", "ks", "ts", "ps"]:
         if xx not in gbhu.columns:
             gbhu[xx] = None
 
-    gbhu["lokalId"] = gbhu.identifikasjon.map(lambda x: x["lokalId"])
+    gbhu["lokalId"] = _pluck(gbhu.identifikasjon, "lokalId")
 
     ss_href_list = {xx.lokalId: xx.ss[0]["href"] if isinstance(xx.ss, list) else None for xx in gbhu.dropna(subset=["ss"]).itertuples()}
     ks_href_list = {xx.lokalId: xx.ks[0]["href"] if isinstance(xx.ks, list) else None for xx in gbhu.dropna(subset=["ks"]).itertuples()}
     ts_href_list = {xx.lokalId: xx.ts[0]["href"] if isinstance(xx.ts, list) else None for xx in gbhu.dropna(subset=["ts"]).itertuples()}
     # ps_href_list = {xx.identifikasjon['lokalId']: xx.ps[0]["href"] if isinstance(xx.ps, list) else None for xx in gbhu.dropna(subset=["ps"]).itertuples()}
 
-    logger.info("fetching rp")
-    ss = await get_soundings(list(ss_href_list.values()), method = "rp")
-    logger.info("fetching ks")
-    ks = await get_soundings(list(ks_href_list.values()), method = "tot")
-    logger.info("fetching cpt")
-    ts = await get_soundings(list(ts_href_list.values()), method = "cpt")
-    # ps = await get_soundings(list(ps_href_list.values()), method = "prv")
+    # the soundings of all methods are fetched together, then all their observations
+    href_lists = {"rp": list(ss_href_list.values()), 
+                  "tot": list(ks_href_list.values()), 
+                  "cpt": list(ts_href_list.values())}
+    logger.info("fetching rp, ks, cpt")
+    ksd_lists = _split_by_length(await get_href_list(sum(href_lists.values(), [])), href_lists)
+    observation_hrefs = {method: _observation_hrefs(ksd_lists[method], method) for method in href_lists}
+    ks_data_lists = _split_by_length(await get_href_list(sum(observation_hrefs.values(), [])), observation_hrefs)
+    ss, ks, ts = [_soundings_to_dataframes(ksd_lists[method], ks_data_lists[method], method) for method in href_lists]
     
-    borehole_list = []
-
     logger.info("creating gdf")
+    # the columns of all methods are gathered first and the frame is built once
+    method_types, sounding_data, method_ids = [], [], []
     for ref, data, method in zip([ss_href_list, ks_href_list, ts_href_list],[ss, ks, ts], ['rp', 'tot', 'cpt']):
-        if len(data) == 0:
-            continue
-        boreholes = gpd.GeoDataFrame(columns=['method_type', 'geometry', 'location_name', 'data', 'x', 'y', 'z','depth', 
-        'method_id', 'method_status', 'method_status_id'], 
-        crs=gbhu.crs)
-
-        boreholes['data'] = data
-        boreholes['method_type'] = method
-        boreholes['method_id'] = list(ref.keys())
-        boreholes['depth'] = [xx["depth"].max() for xx in data]
-        boreholes["method_status_id"] = 3
-        boreholes["method_status"] = "conducted"
-        borehole_list.append(boreholes)
-
-    if len(borehole_list) > 0:
-        boreholes_out = pd.concat(borehole_list)
-        boreholes_out = boreholes_out.reset_index(drop=True)
+        method_types += [method] * len(data)
+        sounding_data += data
+        method_ids += list(ref.keys())
+
+    if len(sounding_data) > 0:
+        n_boreholes = len(sounding_data)
+        # gbhu rows aligned with the soundings through their lokalId
+        gbhu_rows = gbhu.drop_duplicates(subset="lokalId").set_index("lokalId").reindex(method_ids)
+        geometry = gbhu_rows["geometry"].values
+        boreholes_out = gpd.GeoDataFrame({'method_type': method_types,
+                                          'geometry': geometry,
+                                          'location_name': None,
+                                          'data': pd.Series(sounding_data, dtype=object),
+                                          'x': shapely.get_x(geometry),
+                                          'y': shapely.get_y(geometry),
+                                          'z': gbhu_rows["høyde"].to_numpy(),
+                                          # fmax skips NaN like Series.max, and gives NaN for empty soundings
+                                          'depth': np.fromiter((np.fmax.reduce(xx["depth"].to_numpy(dtype=np.float64), initial=np.nan)
+                                                                for xx in sounding_data),
+                                                               dtype=np.float64, count=n_boreholes),
+                                          'method_id': method_ids,
+                                          'method_status': "conducted",
+                                          'method_status_id': 3},
+                                         crs=gbhu.crs)
         
         boreholes_out = _get_depth_rock_boreholes(boreholes_out, gbhu)
-        boreholes_out["geometry"] = boreholes_out.method_id.map(lambda x: gbhu.query("lokalId == @x").iloc[0]["geometry"])
-        boreholes_out[["x", "y"]] = boreholes_out["geometry"].get_coordinates()
-        boreholes_out['z'] = boreholes_out.method_id.map(lambda x: gbhu.query("lokalId == @x").iloc[0]["høyde"])
-        
-        
-        upunkt_href = await get_href_list(boreholes_out.method_id.map(lambda x: gbhu.query("lokalId == @x").iloc[0].undersPkt["href"]).to_list())
-        boreholes_out["location_name"] = [vv["properties"]["boreNr"] for vv in upunkt_href]
+
+        upunkt_href = await get_href_list(_pluck(gbhu_rows["undersPkt"], "href").tolist())
+        boreholes_out["location_name"] = [vv["properties"]["boreNr"] if vv is not None else None for vv in upunkt_href]
 
     else:
         boreholes_out = None
     return boreholes_out
 
 
+def _join_columns(right: pd.DataFrame, left: pd.DataFrame, keys: list = ()) -> pd.DataFrame:
+    """
+    Slice right to the SAMPLE_COLUMNS (and join keys) that left does not already have.
+    """
+    return right[[col for col in right.columns if (col in SAMPLE_COLUMNS or col in keys) and col not in left.columns]]
+
+
+def _feature_properties(pages: list):
+    """
+    Iterate the properties of the features of a list of feature collections, skipping missing pages.
+    """
+    return chain.from_iterable((feature["properties"] for feature in page["features"]) for page in pages if page is not None)
+
+
+def _records_to_frame(records: list, keys) -> pd.DataFrame:
+    """
+    Build a DataFrame column by column from only the given keys of a list of dicts. Keys missing from
+    every record are left out, as pd.DataFrame.from_records would.
+    """
+    present = set().union(*records)
+    return pd.DataFrame({key: [record.get(key) for record in records] for key in dict.fromkeys(keys) if key in present},
+                        index=pd.RangeIndex(len(records)))
+
+
+def _pluck(col: pd.Series, key: str) -> np.ndarray:
+    """
+    Get the value of key from each dict of a column of dicts (None where the row is empty).
+    """
+    return np.fromiter((xx.get(key) if isinstance(xx, dict) else None for xx in col.values), dtype=object, count=len(col))
+
+
+def _to_float(df: pd.DataFrame, columns) -> pd.DataFrame:
+    """
+    Cast the given columns (when present) to float64, so missing values and values sent as strings
+    do not leave them as object columns for the sorting and aggregations downstream.
+    """
+    columns = [col for col in columns if col in df.columns]
+    df[columns] = df[columns].apply(pd.to_numeric, errors="coerce").astype(np.float64)
+    return df
+
+
+def _split_by_length(items: list, lists: dict) -> dict:
+    """
+    Split a flat list of results back into the keys of the dict of lists it was concatenated from.
+    """
+    out = {}
+    start = 0
+    for key, values in lists.items():
+        out[key] = items[start:start + len(values)]
+        start += len(values)
+    return out
+
+
 def _get_depth_rock_boreholes(boreholes_df, gbhu_df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    boreholes = boreholes_df.copy()
     if "boretLengdeTilBerg" not in gbhu_df.columns:
-        boreholes["depth_rock"] = np.nan
-        boreholes["depth_rock_quality"] = np.nan
-    else:
-        for item in boreholes.itertuples():
-            mid = item.method_id  # noqa: F841
-            gg = gbhu_df.query("lokalId == @mid").iloc[0]
-            if isinstance(gg.boretLengdeTilBerg, dict):
-                depth_rock_value = gg.boretLengdeTilBerg.get("borlengdeTilBerg")
-                depth_rock_quality_value = gg.boretLengdeTilBerg.get("borlengdeKvalitet")
-
-                boreholes.loc[item.Index, "depth_rock"] = float(depth_rock_value) if depth_rock_value is not None else np.nan
-                boreholes.loc[item.Index, "depth_rock_quality"]  = int(depth_rock_quality_value) if depth_rock_quality_value is not None else np.nan
-            else:
-                boreholes.loc[item.Index, "depth_rock"] = np.nan
-                boreholes.loc[item.Index, "depth_rock_quality"] = np.nan
-    return boreholes
+        return boreholes_df.assign(depth_rock=np.nan, depth_rock_quality=np.nan)
 
-def get_collection(collection, bounds, limit = 1000):
+    rock_depths = (gbhu_df.drop_duplicates(subset="lokalId")
+                          .set_index("lokalId")["boretLengdeTilBerg"]
+                          .reindex(boreholes_df.method_id))
+    return boreholes_df.assign(
+        depth_rock=pd.to_numeric(_pluck(rock_depths, "borlengdeTilBerg"), errors="coerce"),
+        depth_rock_quality=pd.to_numeric(_pluck(rock_depths, "borlengdeKvalitet"), errors="coerce"))
+
+async def get_collection_async(collection, bounds, limit = 1000, client: httpx.AsyncClient = None):
     """
     Fetches a collection of geospatial data within specified bounds from the NADAG API.
     see documentation at https://ogcapitest.ngu.no/rest/services/grunnundersokelser_utvidet
@@ -270,14 +570,15 @@ def get_collection(collection, bounds, limit = 1000):
         collection (str): The name of the collection to fetch. For example, 'geotekniskborehullunders'.
         bounds (tuple): A tuple representing the bounding box coordinates (minx, miny, maxx, maxy).
         limit (int, optional): The maximum number of records to fetch per request. Defaults to 1000.
+        client (httpx.AsyncClient, optional): Client to use. Defaults to the shared client.
     Returns:
         gpd.GeoDataFrame: A GeoDataFrame containing the fetched geospatial data. Returns an empty GeoDataFrame if no data is found.
     Raises:
-        requests.exceptions.RequestException: If there is an issue with the HTTP request.
+        httpx.HTTPError: If there is an issue with the HTTP request.
         ValueError: If the response cannot be parsed as JSON.
     """
     
-    bbox = gpd.GeoDataFrame(geometry=[box(*bounds)], crs=CRS).to_crs(CRS_API).total_bounds
+    bbox = _BBOX_TRANSFORMER.transform_bounds(*bounds)
     url = URL.format(collection=collection)
 
     ss = f"{bbox[0]} {bbox[1]},{bbox[0]} {bbox[3]},{bbox[2]} {bbox[3]},{bbox[2]} {bbox[1]},{bbox[0]} {bbox[1]}"
@@ -286,149 +587,220 @@ def get_collection(collection, bounds, limit = 1000):
     params = {
         'filter-lang': 'cql2-text',
         'filter': f"S_INTERSECTS(posisjon,POLYGON(({ss})))",
-        'crs': valid_crs[CRS],
+        'crs': get_api_data()[1][CRS],
         'limit': limit
     }
 
-
-    data_list = []
-    next_page = True
-    cont = 0
-
-    while next_page:
-        cont += 1
-        response = requests.get(url, params if cont == 1 else None)
-        # print(response.url)
-        response.raise_for_status()
-        try:
-            data = response.json()
-        except Exception as e:
-            print("Error in response")
-            print(requests.Request('GET', url).prepare().url)
-            raise e
-
-
-        links_rel = list(map(lambda x: x.get("rel"), data["links"]))
-        if "next" in links_rel:
-            url = list(filter(lambda x: x.get("rel") == "next", data["links"]))[0]["href"]
-            next_page = True
-        else:
-            next_page = False
-        data_list.extend(data["features"])
+    data_list = await _get_features(url, params, client)
     if len(data_list) == 0:
         return gpd.GeoDataFrame()
     else:
-        return gpd.GeoDataFrame.from_features(data_list, crs=CRS)
-    
+        return _features_to_gdf(data_list)
 
-def get_collection_bbox(collection, bounds, limit = 1000):
+
+async def get_collection_bbox_async(collection, bounds, limit = 1000, client: httpx.AsyncClient = None):
     """
-    Fetches a collection of geospatial data within specified bounds from the NADAG API.
+    Fetches a collection of geospatial data within specified bounds from the NADAG API, using the bbox parameter.
     see documentation at https://ogcapitest.ngu.no/rest/services/grunnundersokelser_utvidet
     Args:
         collection (str): The name of the collection to fetch. For example, 'geotekniskborehullunders'.
         bounds (tuple): A tuple representing the bounding box coordinates (minx, miny, maxx, maxy).
         limit (int, optional): The maximum number of records to fetch per request. Defaults to 1000.
+        client (httpx.AsyncClient, optional): Client to use. Defaults to the shared client.
     Returns:
         gpd.GeoDataFrame: A GeoDataFrame containing the fetched geospatial data. Returns an empty GeoDataFrame if no data is found.
     Raises:
-        requests.exceptions.RequestException: If there is an issue with the HTTP request.
+        httpx.HTTPError: If there is an issue with the HTTP request.
         ValueError: If the response cannot be parsed as JSON.
     """
     
-    bbox = gpd.GeoDataFrame(geometry=[box(*bounds)], crs=CRS).to_crs(CRS_API).total_bounds
+    bbox = _BBOX_TRANSFORMER.transform_bounds(*bounds)
     url = URL.format(collection=collection)
     params = {
         'bbox': ','.join(map(str, bbox)),
-        'crs': valid_crs[CRS],
+        'crs': get_api_data()[1][CRS],
         'limit': limit
     }
     
-    
-    data_list = []
-    next_page = True
-    cont = 0
-    while next_page:
-        cont += 1
-        response = requests.get(url, params=params if cont == 1 else None)
-        print(response.url)
-        response.raise_for_status()
-        try:
-            data = response.json()
-        except Exception as e:
-            print("Error in response")
-            print(requests.Request('GET', url).prepare().url)
-            raise e
-            
-        
-        links_rel = list(map(lambda x: x.get("rel"), data["links"]))
-        if "next" in links_rel:
-            url = list(filter(lambda x: x.get("rel") == "next", data["links"]))[0]["href"]
-            next_page = True
-        else:
-            next_page = False
-        data_list.extend(data["features"])
+    data_list = await _get_features(url, params, client)
     if len(data_list) == 0:
         return gpd.GeoDataFrame()
     else:
-        return gpd.GeoDataFrame.from_features(data_list, crs=CRS)
+        return _features_to_gdf(data_list)
+
+
+def get_collection(collection, bounds, limit = 1000):
+    """
+    Synchronous wrapper around get_collection_async, see its documentation.
+    """
+    return _run_sync(get_collection_async, collection, bounds, limit)
+
+
+def get_collection_bbox(collection, bounds, limit = 1000):
+    """
+    Synchronous wrapper around get_collection_bbox_async, see its documentation.
+    """
+    return _run_sync(get_collection_bbox_async, collection, bounds, limit)
+
+
+def _features_to_gdf(features: list) -> gpd.GeoDataFrame:
+    """
+    Build a GeoDataFrame from a list of GeoJSON features, like gpd.GeoDataFrame.from_features but with the
+    properties and geometries collected column-wise. Point geometries (the boreholes) are created in one
+    vectorized shapely call.
+    """
+    geometries = [feature.get("geometry") for feature in features]
+    if all(geometry is not None and geometry["type"] == "Point" for geometry in geometries):
+        try:
+            geometry = shapely.points(np.array([geometry["coordinates"] for geometry in geometries], dtype=np.float64))
+        except ValueError:
+            # mixed 2d/3d coordinates
+            geometry = [shapely.geometry.shape(geometry) for geometry in geometries]
+    else:
+        geometry = [shapely.geometry.shape(geometry) if geometry else None for geometry in geometries]
+    properties = pd.DataFrame.from_records([feature["properties"] or {} for feature in features],
+                                           index=pd.RangeIndex(len(features)))
+    # geometry as the first column, as from_features orders it
+    properties.insert(0, "geometry", gpd.GeoSeries(geometry, index=properties.index, crs=CRS))
+    return gpd.GeoDataFrame(properties, geometry="geometry", crs=CRS)
+
+
+async def _get_features(url: str, params: dict, client: httpx.AsyncClient = None) -> list:
+    """
+    Fetches all the features of a paginated items request. When the first page reports numberMatched,
+    the remaining pages are requested concurrently by offset; otherwise the "next" links are followed.
+    """
+    if client is None:
+        client = _get_client()
+
+    data = await _get_page(client, url, params)
+    data_list = list(data["features"])
+
+    number_matched = data.get("numberMatched")
+    page_size = len(data_list)
+    if number_matched is not None and page_size > 0:
+        offsets = range(page_size, number_matched, page_size)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def get_offset(offset):
+            async with semaphore:
+                return await _get_page(client, url, params | {'offset': offset})
+
+        pages = await asyncio.gather(*[get_offset(offset) for offset in offsets])
+        for page in pages:
+            data_list.extend(page["features"])
+    else:
+        next_href = _next_link(data)
+        while next_href is not None:
+            data = await _get_page(client, next_href)
+            data_list.extend(data["features"])
+            next_href = _next_link(data)
+
+    return data_list
+
+
+async def _get_page(client: httpx.AsyncClient, url: str, params: dict = None) -> dict:
+    # httpx replaces the query string of the url with params, so merge them into the url (keeps ?f=json)
+    response = await client.get(httpx.URL(url).copy_merge_params(params or {}))
+    response.raise_for_status()
+    try:
+        data = orjson.loads(response.content)
+    except Exception as e:
+        print("Error in response")
+        print(response.url)
+        raise e
+    return data
+
+
+def _next_link(data: dict) -> str:
+    next_links = [xx["href"] for xx in data.get("links", []) if xx.get("rel") == "next"]
+    return next_links[0] if len(next_links) > 0 else None
+
+
+def _run_sync(func, *args, **kwargs):
+    """
+    Run an async NADAG function to completion from synchronous code, with its own client.
+    If an event loop is already running (e.g. in a notebook), it runs in a separate thread.
+    """
+    async def runner():
+        async with _new_client() as client:
+            return await func(*args, client=client, **kwargs)
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(runner())
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, runner()).result()
 
 
 async def get_samples(gbhu, aggregate=True, map_layer_composition=True) -> gpd.GeoDataFrame:
     gbhu = gbhu.rename(columns={"metode-GeotekniskPrøveserie": "ps"})
     if "ps" not in gbhu.columns:
         return None
-    bh = gbhu.dropna(subset=["ps"]).copy()
-    bh["lokalId"] = bh.identifikasjon.map(lambda x: x["lokalId"])
+    bh = gbhu.dropna(subset=["ps"])
+    bh = bh.assign(lokalId=_pluck(bh.identifikasjon, "lokalId"))
     
-    href_list = list(map(lambda x: x["href"], bh.ps.map(lambda x: x[0])))
-    samples = await get_href_list(href_list)
+    # the borehole names only depend on bh, fetch them while the sample chain below is resolved
+    borenr_task = asyncio.create_task(get_href_list(_pluck(bh.undersPkt, "href").tolist()))
 
-    href_list = list(map(lambda x: x["href"], bh.undersPkt))
-    borenr = await get_href_list(href_list)
-    bh["borenr"] = [xx["properties"]["boreNr"] for xx in borenr]
+    href_list = _pluck(bh.ps.str[0], "href").tolist()
+    samples = await get_href_list(href_list)
     
-    sample_info = [feature["properties"] for p in samples for feature in p["features"]]
-    sample_df = pd.DataFrame(sample_info)
-    sample_df["lokalId"] = sample_df.identifikasjon.map(lambda x: x["lokalId"])
-    sample_df = sample_df.drop(columns=["identifikasjon"])    
+    # only the columns used downstream are materialized
+    sample_df = _records_to_frame(list(_feature_properties(samples)), 
+                                  ["identifikasjon", "harPrøveseriedel", "geotekniskborehullunders"])
+    sample_df["lokalId"] = _pluck(sample_df.identifikasjon, "lokalId")
     
-    href_list = sample_df.harPrøveseriedel.map(lambda x: x["href"]).to_list()
+    href_list = _pluck(sample_df.harPrøveseriedel, "href").tolist()
     samples_psd = await get_href_list(href_list)
     
-    sample_data_general_dict = [feature["properties"] for p in samples_psd for feature in p["features"]]
-    sample_data_general = pd.DataFrame(sample_data_general_dict)
-    sample_data_general["ps_id"] = sample_data_general["tilhørerPrøveserie"].map(lambda x: x["title"])
+    sample_data_general_dict = list(_feature_properties(samples_psd))
+    sample_data_general = _records_to_frame(sample_data_general_dict, 
+                                            [*SAMPLE_COLUMNS, "prøveseriedelId", "tilhørerPrøveserie"])
+    sample_data_general["ps_id"] = _pluck(sample_data_general["tilhørerPrøveserie"], "title")
     sample_data_general = sample_data_general.drop(columns=["tilhørerPrøveserie"])
 
 
     href_list = [p["harData"]["href"] if "harData" in p else None for p in sample_data_general_dict ]
     sample_data_dict = await get_href_list(href_list)
     
-    sample_data = pd.DataFrame([feature["properties"] for p in sample_data_dict for feature in p["features"]])
+    sample_data = _records_to_frame(list(_feature_properties(sample_data_dict)), 
+                                    [*SAMPLE_COLUMNS, "tilhørerPrøveseriedel"])
 
-    sample_data["psd_id"] = sample_data["tilhørerPrøveseriedel"].map(lambda x: x["title"])
+    sample_data["psd_id"] = _pluck(sample_data["tilhørerPrøveseriedel"], "title")
     sample_data = sample_data.drop(columns=["tilhørerPrøveseriedel"])
+
+    borenr = await borenr_task
+    bh["borenr"] = [xx["properties"]["boreNr"] if xx is not None else None for xx in borenr]
     
 
-    sample_merged = (
-        sample_data.merge(sample_data_general, left_on="psd_id", right_on="prøveseriedelId", suffixes=('', '_general'))
-                   .merge(sample_df[["lokalId", "geotekniskborehullunders"]], left_on="ps_id", right_on="lokalId", suffixes=('', '_df'))
-                   .merge(bh, left_on="geotekniskborehullunders", right_on="lokalId", suffixes=('', '_bh'))
-                     )
+    # inner joins against frames indexed by their key. Only the columns still missing on the left are joined
+    # (the left value won in the suffixed merges), so no suffixed duplicates are created and dropped
+    sample_merged = sample_data.join(
+        _join_columns(sample_data_general.set_index("prøveseriedelId", drop=False), sample_data, ["ps_id"]),
+        on="psd_id", how="inner")
+    sample_merged = sample_merged.join(
+        _join_columns(sample_df[["lokalId", "geotekniskborehullunders"]].set_index("lokalId"), sample_merged, 
+                      ["geotekniskborehullunders"]),
+        on="ps_id", how="inner")
+    sample_merged = sample_merged.join(
+        _join_columns(bh.set_index("lokalId"), sample_merged),
+        on="geotekniskborehullunders", how="inner").reset_index(drop=True)
     
     for col in SAMPLE_COLUMNS:
         if col not in sample_merged.columns:
             sample_merged[col] = None
 
     sample_merged = sample_merged[SAMPLE_COLUMNS]
-    columns_to_drop = [col for col in sample_merged.columns if col.endswith('_general') or col.endswith('_df') or col.endswith('_bh')]
-    sample_merged = sample_merged.drop(columns=columns_to_drop)
 
-    sample_merged.columns = sample_merged.columns.str.lower()
+    sample_merged.columns = [col.lower() for col in sample_merged.columns]
 
-    sample_merged = sample_merged.rename(columns=COLUMN_MAPPER_SA)
-    sample_merged['layer_composition'] = sample_merged['layer_composition'].map(lambda x: str(x).lower())
+    sample_merged = sample_merged.rename(columns=COLUMN_MAPPER_SA).pipe(_to_float, NUMERIC_COLUMNS_SA)
+    # lower-case each distinct description once (missing values become "nan")
+    codes, uniques = pd.factorize(sample_merged['layer_composition'].to_numpy(dtype=object))
+    sample_merged['layer_composition'] = np.array([str(xx).lower() for xx in uniques] + ["nan"], dtype=object)[codes]
     
     sample_merged = sample_merged.drop(columns=
                                        ['lagposisjon', 'prøvemetode', 'labanalyse', 'boretlengde', 
@@ -444,61 +816,63 @@ async def get_samples(gbhu, aggregate=True, map_layer_composition=True) -> gpd.G
             sample_merged = aggregate_samples(sample_merged)
         elif map_layer_composition:
             
-            sample_merged["layer_composition"] = sample_merged.layer_composition.map(
-                _clf_single
-                )
+            sample_merged["layer_composition"] = _clf_layer_composition(sample_merged.layer_composition)
         
 
     samples_gdf = gpd.GeoDataFrame(sample_merged, crs=bh.crs) if len(sample_merged) > 0 else None
 
     if samples_gdf is not None:
-        # field manager placeholders
-        samples_gdf["method_status_id"] = 3
-        samples_gdf["method_type"] = "sa"
-        samples_gdf["method_status"] = "conducted"
-        samples_gdf["method_id"] = 4
-
-        samples_gdf[['x', 'y']] = samples_gdf.get_coordinates().round(1)
-        samples_gdf["z"] = samples_gdf["location_elevation"]
-        samples_gdf["depth"] = (samples_gdf.depth_base + samples_gdf.depth_top)/2
+        geometry = samples_gdf.geometry.values
+        # placeholder and derived columns
+        samples_gdf = samples_gdf.assign(**{
+            # field manager placeholders
+            "method_status_id": 3,
+            "method_type": "sa",
+            "method_status": "conducted",
+            "method_id": 4,
+            "x": shapely.get_x(geometry).round(1),
+            "y": shapely.get_y(geometry).round(1),
+            "z": samples_gdf["location_elevation"].to_numpy(),
+            "depth": _get_sample_depth(samples_gdf.depth_top.to_numpy(dtype=float),
+                                       samples_gdf.depth_base.to_numpy(dtype=float))})
 
     
     return samples_gdf
 
 
-def _clf_aggr(x):
-    values = x.unique()
-    if all([vv in ("nan", "none") for vv in values]):
-        return "nothing"
-    else:
-        for xx in values:
-            if any(kwd in xx.lower() for kwd in QCL_KWD):
-                return "quick_clay"
-        return 'other'
-        
+def _get_sample_depth(depth_top: np.ndarray, depth_base: np.ndarray) -> np.ndarray:
+    """
+    Representative depth of the samples: the middle of the sample interval, or the top depth
+    when the base depth is missing or not reported (0).
+    """
+    missing_base = np.isnan(depth_base) | ((depth_base == 0) & (depth_top > depth_base))
+    return np.where(missing_base, depth_top, (depth_top + depth_base) / 2)
 
-def _clf_single(x):
-    if x in ("nan", "none"):
-        return "nothing"
-    if any(kwd in x.lower() for kwd in QCL_KWD):
-        return "quick_clay"
-    else:
-        return "other"
+
+def _clf_layer_composition(layer_composition: pd.Series) -> np.ndarray:
+    """
+    Classify lower-cased layer composition descriptions as "nothing" (missing), "quick_clay" (contains a QCL_KWD
+    keyword) or "other", as one vectorized string match over the column.
+    """
+    is_nothing = layer_composition.isna() | layer_composition.isin(("nan", "none"))
+    is_qcl = layer_composition.str.contains(QCL_RE, na=False)
+    return np.where(is_nothing, "nothing", np.where(is_qcl, "quick_clay", "other"))
 
 
 
 def aggregate_samples(samples_gdf: gpd.GeoDataFrame, id_field:str = 'prøveseriedelid') -> gpd.GeoDataFrame:
     
     
-    def take_any(x):
-        return x.iloc[0]
-    
-    
-    default_agg_func = take_any
+    # built-in aggregations only, so every column is reduced in the cythonized groupby path
+    default_agg_func = 'first'
+
+    # rank the layer composition labels, the group label is the highest ranked one
+    samples_gdf = samples_gdf.assign(layer_composition=pd.Categorical(
+        _clf_layer_composition(samples_gdf.layer_composition), categories=LAYER_COMPOSITION_LABELS).codes)
 
     agg_funcs = {
         'water_content': 'mean',    # Sumar los valores de la columna A
-        'layer_composition': _clf_aggr,
+        'layer_composition': 'max',
         'liquid_limit': 'mean', 
         'plastic_limit': 'mean',
         'strength_undisturbed': 'min',
@@ -511,50 +885,75 @@ def aggregate_samples(samples_gdf: gpd.GeoDataFrame, id_field:str = 'prøveserie
     # Crear un diccionario de funciones de agregación que incluya la función por defecto
     agg_funcs_with_default = {col: agg_funcs.get(col, default_agg_func) for col in samples_gdf.columns}
     samples = samples_gdf.groupby(id_field, as_index=False).agg(agg_funcs_with_default)
-
+    samples["layer_composition"] = np.asarray(LAYER_COMPOSITION_LABELS)[samples.layer_composition]
 
     return samples
 
 
 async def get_data_big_areas(bounds: tuple, max_dist_query:int=2000,
-                             include_samples=True) -> gpd.GeoDataFrame:
+                             include_samples=True, aoi: gpd.GeoDataFrame = None) -> gpd.GeoDataFrame:
+    """
+    Get the borehole investigations, soundings and samples for a big area. The collection is fetched
+    with a single paginated query and the boreholes are then assigned to a grid of max_dist_query sized
+    tiles with a spatial join, so every borehole is processed exactly once.
+
+    Args:
+        bounds: tuple with the bounding box (xmin, ymin, xmax, ymax)
+        max_dist_query: size of the tiles the soundings and samples are requested by
+        include_samples: also get the samples
+        aoi: optional GeoDataFrame with the area of interest, only boreholes intersecting it are kept
+
+    Returns:
+        gbhu: GeoDataFrame with the borehole investigations
+        borehole_gdf: DataFrame with the soundings
+        sample_gdf: DataFrame with the samples (None if include_samples is False)
+    """
     from core_components.utils.geo import split_bbox
     from tqdm.notebook import tqdm
 
+    gbhu = await get_collection_async("geotekniskborehullunders", bounds)
+    if aoi is not None and not gbhu.empty:
+        # join only against the geometry to avoid carrying the aoi columns along
+        gbhu = gbhu.loc[gpd.sjoin(gbhu[["geometry"]], aoi[["geometry"]].to_crs(gbhu.crs),
+                                  predicate="intersects", how="inner").index.unique()]
+    if gbhu.empty:
+        return gbhu, None, None
+
     n_cols, n_rows = max((bounds[2]-bounds[0])//max_dist_query,1),max((bounds[3]-bounds[1])//max_dist_query,1)
     sub_boxes = split_bbox(gpd.GeoDataFrame(geometry=[box(*bounds)], crs=CRS), n_rows, n_cols)
-    gbhu_list = []
 
-    for item in tqdm(sub_boxes.itertuples(), total=len(sub_boxes)):
-        gbhu = get_collection("geotekniskborehullunders", tuple(item.geometry.bounds))
-        gbhu_list.append(gbhu)
+    # boreholes on a shared tile edge match several tiles, keep the first one
+    tile_of = gpd.sjoin(gbhu[["geometry"]], sub_boxes[["geometry"]].to_crs(gbhu.crs),
+                        predicate="intersects", how="inner")["index_right"]
+    tile_of = tile_of[~tile_of.index.duplicated()]
+    chunks = [gbhu.loc[index] for index in tile_of.groupby(tile_of, sort=True).groups.values()]
 
-    gbhu_list = [item for item in gbhu_list if not (item is None or item.empty)]
-    gbhu = pd.concat(gbhu_list)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
 
-    borehole_list = []
-    sample_list = []
-
-    for ii, item in tqdm(enumerate(gbhu_list)):
-        if item.empty:
-            borehole_list.append(None)
-            sample_list.append(None)
-        else:
+    async def process_chunk(ii, chunk):
+        async with semaphore:
             try:
-                boreholes = await get_all_soundings(item)
                 if include_samples:
-                    samples = await get_samples(item)
+                    boreholes, samples = await asyncio.gather(get_all_soundings(chunk), get_samples(chunk))
                 else:
-                    samples = None
+                    boreholes, samples = await get_all_soundings(chunk), None
             except Exception as e:
-                logger.error(f"error at {item.location_name}, index {ii}: {e}")
-                boreholes = None
-                samples = None
-            borehole_list.append(boreholes)
-            sample_list.append(samples)
+                logger.error(f"error at index {ii}: {e}")
+                return ii, None, None
+        return ii, boreholes, samples
+
+    borehole_list = [None] * len(chunks)
+    sample_list = [None] * len(chunks)
 
-    borehole_gdf = pd.concat(borehole_list, ignore_index=True)
-    sample_gdf = pd.concat(sample_list, ignore_index=True)
+    tasks = [process_chunk(ii, chunk) for ii, chunk in enumerate(chunks)]
+    for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+        ii, borehole_list[ii], sample_list[ii] = await task
+
+    # chunks that failed are None, there is nothing to concatenate if all of them did
+    borehole_list = [boreholes for boreholes in borehole_list if boreholes is not None]
+    sample_list = [samples for samples in sample_list if samples is not None]
+    borehole_gdf = pd.concat(borehole_list, ignore_index=True) if borehole_list else None
+    sample_gdf = pd.concat(sample_list, ignore_index=True) if include_samples and sample_list else None
 
     return gbhu, borehole_gdf, sample_gdf
 
@@ -581,8 +980,14 @@ def get_rock_depth_dataset(gbhu,
     _fields = ["geometry", "elevation", "rock_depth", "rock_elevation", "rock_depth_quality", "source"]
 
     gdf = gbhu[["boretLengdeTilBerg", "høyde", "geometry"]].dropna(subset="boretLengdeTilBerg")
-    gdf["rock_depth"] = gdf.boretLengdeTilBerg.map(lambda x: x.get('borlengdeTilBerg'))
-    gdf["rock_depth_quality"]  = gdf.boretLengdeTilBerg.map(lambda x: int(x.get('borlengdeKvalitet')) if isinstance(x, dict) else 0)
+    # one pass over the dicts for both fields, into typed arrays
+    rock_values = [(xx.get('borlengdeTilBerg'), xx.get('borlengdeKvalitet')) if isinstance(xx, dict) else (None, None)
+                   for xx in gdf.boretLengdeTilBerg.to_numpy()]
+    gdf = gdf.assign(
+        rock_depth=np.fromiter((np.nan if depth is None else float(depth) for depth, _ in rock_values), 
+                               dtype=np.float64, count=len(rock_values)),
+        rock_depth_quality=np.fromiter((0 if quality is None else int(quality) for _, quality in rock_values), 
+                                       dtype=np.int64, count=len(rock_values)))
     gdf = gdf.drop(columns="boretLengdeTilBerg")
     gdf = gdf.rename(columns={"høyde": "elevation"})
     gdf["rock_elevation"] = gdf.elevation - gdf.rock_depth
@@ -610,26 +1015,59 @@ def get_rock_depth_dataset(gbhu,
     return gdf_depth
 
 
-def create_flagged_column(df, col_start, col_end):
-    changes = pd.Series(0, index=df.index)
-    changes[df[col_start]] = 1
-    changes[df[col_end]] = -1
-    
-    cum_state = changes.cumsum()
-    
-    return cum_state > 0
-
-
-def create_intervals_from_comments(input_df):
-    df = input_df.copy()
-    flag_codes = cfg["nadag"]["flag_codes"]
-
+def create_flagged_column(df: pd.DataFrame, col_start: str, col_end: str) -> pd.Series:
+    """
+    Flag the rows of df between a start and an end marker (see _flag_intervals)
+    Args:
+        df: DataFrame with the boolean marker columns
+        col_start: name of the column that is True where an interval starts
+        col_end: name of the column that is True where an interval ends
+    Returns:
+        pd.Series: boolean flag of each row, with the index of df
+    """
+    return pd.Series(_flag_intervals(df[col_start].to_numpy(dtype=bool), df[col_end].to_numpy(dtype=bool)),
+                     index=df.index)
 
-    df["comment_code"] = df["comment_code"].map(lambda x: str(int(x)) if x is not None and not isinstance(x, str) else x)
-    for col, codes in flag_codes.items():
-        df[col] = df["comment_code"].apply(lambda x: any(code in x for code in codes) if x is not None else False)
 
-    for col in ["hammering", "increased_rotation_rate", "flushing"]:
-           df[col] = create_flagged_column(df, col+"_starts", col+"_ends")
-    
-    return df[["hammering", "increased_rotation_rate", "flushing"]]
\ No newline at end of file
+def _flag_intervals(starts: np.ndarray, ends: np.ndarray, groups: np.ndarray = None) -> np.ndarray:
+    """
+    Flag the rows between a start and an end marker: a start switches the flag on, an end switches it off
+    (an end wins if both are on the same row), and rows without markers keep the previous state.
+    Args:
+        starts: boolean array, True where an interval starts
+        ends: boolean array, True where an interval ends
+        groups: optional array with the sounding of each row (rows of a sounding must be contiguous),
+                the flag is reset at the first row of each sounding
+    Returns:
+        boolean array with the flag of each row
+    """
+    markers = starts | ends
+    if groups is not None and len(groups) > 0:
+        markers[1:] |= groups[1:] != groups[:-1]
+
+    # index of the last row with a marker, carried forward
+    last_marker = np.arange(len(starts))
+    last_marker[~markers] = -1
+    np.maximum.accumulate(last_marker, out=last_marker)
+
+    state = (starts & ~ends)[last_marker]
+    state[last_marker < 0] = False
+    return state
+
+
+def create_intervals_from_comments(input_df, groups: np.ndarray = None):
+    interval_types = ["hammering", "increased_rotation_rate", "flushing"]
+    if "comment_code" not in input_df.columns:
+        return pd.DataFrame(False, index=input_df.index, columns=interval_types)
+
+    # only the comment codes are read, input_df is not copied or modified.
+    # soundings repeat a few distinct codes: format and match each distinct code once and broadcast
+    # by its factor (missing codes get -1, which picks the trailing False)
+    codes, uniques = pd.factorize(input_df["comment_code"].to_numpy(dtype=object))
+    uniques = [code if isinstance(code, str) else str(int(code)) for code in uniques]
+    events = {col: np.array([pattern.search(code) is not None for code in uniques] + [False], dtype=bool)[codes]
+              for col, pattern in FLAG_CODE_RES.items()}
+
+    return pd.DataFrame({col: _flag_intervals(events[col+"_starts"], events[col+"_ends"], groups)
+                         for col in interval_types},
+                        index=input_df.index)
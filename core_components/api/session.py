@@ -0,0 +1,37 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from core_components.config import get_config
+
+cfg = get_config()
+
+POOL_CONNECTIONS = cfg["http"]["pool_connections"]
+POOL_MAXSIZE = cfg["http"]["pool_maxsize"]
+MAX_RETRIES = cfg["http"]["max_retries"]
+BACKOFF_FACTOR = cfg["http"]["backoff_factor"]
+STATUS_FORCELIST = cfg["http"]["status_forcelist"]
+TIMEOUT = (cfg["http"]["connect_timeout"], cfg["http"]["read_timeout"])
+
+
+def create_session() -> requests.Session:
+    """
+    Create a requests session with a keep-alive connection pool. Connection errors and the status codes in
+    STATUS_FORCELIST are retried with exponential backoff, honouring Retry-After headers.
+    Args:
+    Returns:
+        requests.Session: session with the adapter mounted on http:// and https://
+    """
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                          pool_maxsize=POOL_MAXSIZE,
+                          max_retries=Retry(total=MAX_RETRIES,
+                                            backoff_factor=BACKOFF_FACTOR,
+                                            status_forcelist=STATUS_FORCELIST,
+                                            respect_retry_after_header=True))
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+SESSION = create_session()
@@ -1,3 +1,4 @@
+import asyncio
 from abc import ABC, abstractmethod
 from functools import partial
 import ipyvuetify
@@ -5,6 +6,12 @@ import ipywidgets
 import ipyleaflet
 
 
+WMS_TOGGLE_DELAY = 0.15  # seconds, wms toggles within this time are coalesced
+SIDE_MENU_CLASSES = ("expansion-panel-container", "expansion-panel-header", "expansion-panel-content",
+                     "grid-menu-container", "side-menu-container")
+SIMPLE_SIDE_MENU_CLASSES = ("expansion-panel-header", "expansion-panel-mini-content")
+
+
 class BtnLoader(ipyvuetify.Btn):
     """
     A custom button class that supports loading state toggling.
@@ -28,14 +35,16 @@ class BtnLoader(ipyvuetify.Btn):
     
 
 class Loader(ipyvuetify.Container):
+    _TEMPLATE = "<span>{}</span>"
+
     def __init__(self, text="Loading..."):
         self.loader = ipyvuetify.ProgressLinear(indeterminate=True, height="12", color="red")
-        self.text_widget = self.text_widget = ipywidgets.HTML(value=f"<span>{text}</span>")
+        self.text_widget = ipywidgets.HTML(value=self._TEMPLATE.format(text))
         super().__init__(children=[self.loader, self.text_widget])
     
     def set_text(self, text):
         self.style_ = 'display: block;'
-        self.text_widget.value = f"<span>{text}</span>"
+        self.text_widget.value = self._TEMPLATE.format(text)
         
     def hide(self):
         self.style_ = 'display: none;'
@@ -79,13 +88,13 @@ class OutputPopup(ipyleaflet.Popup):
 
     def relocate_and_open(self, clear_output=True, show=True):
         if clear_output:
-            self.child.clear_output()
+            # the old output is replaced when the new one arrives, no flicker of an empty popup
+            self.child.clear_output(wait=True)
             
         if show:
-            center = self.m.center
-            bounds = self.m.bounds
-            popup_location = (bounds[0][0], center[1])
-            self.open_popup(popup_location)
+            # the location change is synced in one message together with the open
+            with self.hold_sync():
+                self.open_popup((self.m.bounds[0][0], self.m.center[1]))
 
 
 class SideMenu(ipyvuetify.Container):
@@ -102,8 +111,7 @@ class SideMenu(ipyvuetify.Container):
         """
         super().__init__()
 
-        self.classes = ["expansion-panel-container", "expansion-panel-header", "expansion-panel-content",
-                        "grid-menu-container", "side-menu-container"] if classes is None else classes
+        self.classes = SIDE_MENU_CLASSES if classes is None else classes
 
         self.icon = icon
 
@@ -142,12 +150,12 @@ class SimpleSideMenu(ipyvuetify.Layout):
         """
         super().__init__()
 
-        self.classes = ["expansion-panel-header", "expansion-panel-mini-content"] if classes is None else classes
+        self.classes = SIMPLE_SIDE_MENU_CLASSES if classes is None else classes
 
         vepc1 = ipyvuetify.ExpansionPanel(children=[
-            ipyvuetify.ExpansionPanelHeader(class_="expansion-panel-header",
+            ipyvuetify.ExpansionPanelHeader(class_=self.classes[0],
                                             children=[ipyvuetify.Icon(children=[icon], left=True)]),
-            ipyvuetify.ExpansionPanelContent(class_="expansion-panel-mini-content",
+            ipyvuetify.ExpansionPanelContent(class_=self.classes[1],
                                             children=[expansion_panel_items])])
 
         vep = ipyvuetify.ExpansionPanels(children=[vepc1])
@@ -166,40 +174,92 @@ class WMSComponent(SimpleSideMenu):
             wms_panel (ipyvuetify.Container): The panel to be displayed.
         """
         
+        # all the buttons share one layout model
+        button_layout = ipywidgets.Layout(width="auto")
         component_dict = {}
+        buttons = []
         for wms_name, wms_params in wms_dict.items():
-            button = ipywidgets.Button(description=wms_name, layout=ipywidgets.Layout(width="auto"), icon="fa-map",
+            button = ipywidgets.Button(description=wms_name, layout=button_layout, icon="fa-map",
                                        tooltip=f"Add {wms_name} wms-layer")
             component_dict[wms_name] = button
+            buttons.append(button)
             button.on_click(partial(self.action_wms_default, m=m, wms_name=wms_name, wms_params=wms_params))
         
-        wms_layers_box = ipywidgets.VBox(list(component_dict.values()), layout=ipywidgets.Layout(padding="0px 5px 5px 5px"))
+        wms_layers_box = ipywidgets.VBox(buttons, layout=ipywidgets.Layout(padding="0px 5px 5px 5px"))
         super().__init__(expansion_panel_items=wms_layers_box, icon="mdi-map")
         self.items = component_dict
 
 
     @staticmethod
     def action_wms_default(b, m, wms_name, wms_params) -> None:
+        """
+        Toggle the wms layer. The button color changes right away, the layer change is applied after
+        WMS_TOGGLE_DELAY seconds so rapid clicks collapse into a single (net) layer update.
+        """
+        # the pending (delayed) toggle of each wms is kept on its button
+        pending = getattr(b, "_wms_pending", None)
+        if pending is not None:
+            handle, visible = pending
+            handle.cancel()
+        else:
+            layer = WMSComponent._get_wms_layer(m, wms_name)
+            visible = layer is not None and layer.visible
+        visible = not visible
+
+        b.style.button_color = "lightgreen" if visible else None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (outside the kernel), apply right away
+            WMSComponent._set_wms_visible(b, m, wms_name, wms_params, visible)
+            return
+
+        def apply():
+            b._wms_pending = None
+            WMSComponent._set_wms_visible(b, m, wms_name, wms_params, visible)
+
+        b._wms_pending = (loop.call_later(WMS_TOGGLE_DELAY, apply), visible)
 
-        for layer_i in m.layers:
-            if layer_i.name == wms_name and layer_i.visible:
-                layer_i.visible = False
-                b.style.button_color = None
-                return
-            elif layer_i.name == wms_name and not layer_i.visible:
-                layer_i.visible = True
-                b.style.button_color = "lightgreen"
-                return
-        wms = ipyleaflet.WMSLayer(
-            url=wms_params.get('url'),
-            layers=wms_params.get('layers'),
-            format=wms_params.get('format', 'image/png'),
-            transparent=wms_params.get('transparent', True),
-            name=wms_name,
-            visible=True,
-        )
-        b.style.button_color = "lightgreen"
-        m.add(wms)
+    @staticmethod
+    def _get_wms_layer(m, wms_name):
+        named_overlays = getattr(m, "_named_overlays", None)
+        if named_overlays is None:
+            # plain ipyleaflet maps have no overlay index
+            return next((layer_i for layer_i in m.layers if layer_i.name == wms_name), None)
+        return named_overlays.get(wms_name)
+
+    @staticmethod
+    def _set_wms_visible(b, m, wms_name, wms_params, visible) -> None:
+        """
+        Show or hide the wms layer. Heavy layers (the default, wms_params["heavy"]) are removed from the map
+        when hidden, since hidden WMS layers may still request tiles; the layer model is kept on the button
+        and added back when shown again. Light layers only toggle their visibility.
+        """
+        layer = WMSComponent._get_wms_layer(m, wms_name)
+        if layer is not None and (visible or not wms_params.get("heavy", True)):
+            layer.visible = visible
+            return
+        if layer is not None:
+            m.remove(layer)
+            return
+        if not visible:
+            return
+        
+        layer = getattr(b, "_wms_layer", None)
+        if layer is None:
+            layer = ipyleaflet.WMSLayer(
+                url=wms_params.get('url'),
+                layers=wms_params.get('layers'),
+                format=wms_params.get('format', 'image/png'),
+                transparent=wms_params.get('transparent', True),
+                name=wms_name,
+                visible=True,
+            )
+            b._wms_layer = layer
+        layer.visible = True
+        m.add(layer)
+        if hasattr(m, "_named_overlays"):
+            m._named_overlays[wms_name] = layer
     
 
 class GUIBase(ABC):
@@ -1,5 +1,5 @@
 import ipyleaflet
-from shapely.geometry import LineString, Polygon
+import shapely
 import numpy as np
 
 
@@ -14,8 +14,33 @@ BASE_WMS = {'Faresoner': {'url': 'https://nve.geodataonline.no/arcgis/services/S
                       'layers': "GB_standard,GBU_clustered_50px_nolimit", }
             }
 
+BASEMAPS = (
+    {'url': "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png",
+     'name': "OpenStreetMap", 'attribution': "OpenStreetMap"},
+    {'url': "https://services.geodataonline.no/arcgis/rest/services/Geocache_WMAS_WGS84/"
+            "GeocacheBilder/MapServer/tile/{z}/{y}/{x}",
+     'name': "Bilde", 'attribution': "Geodata AS"},
+    {'url': "https://services.geodataonline.no/arcgis/rest/services/Geocache_WMAS_WGS84/"
+            "GeocacheBasis/MapServer/tile/{z}/{y}/{x}",
+     'name': "Basis", 'attribution': "Geodata AS", 'format': "image/png"},
+    )
+
+MAP_CONTROLS = ("draw", "layers", "fullscreen", "search", "scale")
+
+
 class Map(ipyleaflet.Map):
-    def __init__(self, **kwargs):
+    def __init__(self, map_controls: tuple = MAP_CONTROLS, **kwargs):
+        """
+        Args:
+            map_controls (tuple, optional): Names of the controls to add (see MAP_CONTROLS), the others can be
+                                            added later with add_map_control. Defaults to all of them.
+        """
+        # the basemaps and view are passed to the constructor, so ipyleaflet does not create its default
+        # basemap layer and initial view only for them to be replaced right after
+        kwargs["layers"] = tuple(self.basemap_layers())
+        kwargs.setdefault("center", [60.099, 11.122])
+        kwargs.setdefault("zoom", 10)
+        kwargs.setdefault("scroll_wheel_zoom", True)
         super().__init__(**kwargs)
         
         self.color_polyline = "#00F"
@@ -24,26 +49,39 @@ class Map(ipyleaflet.Map):
         
         self.layout.width = "100%"
         self.layout.height = "100%"
-        self.center = [60.099, 11.122] if "center" not in kwargs else kwargs["center"]
-        self.zoom = 10 if "zoom" not in kwargs else kwargs["zoom"]
-        self.scroll_wheel_zoom=True
 
-        self.layers = self.basemap_layers()
-                
         self.map_draw_control = self.setup_draw_control()
-        
-        self.add(self.map_draw_control)
-        
-        self.add(ipyleaflet.LayersControl(position="topright"))
-        self.add(ipyleaflet.FullScreenControl(position="topleft"))
-        self.add(ipyleaflet.SearchControl(url="https://nominatim.openstreetmap.org/search?format=json&q={s}",
-                                          zoom=17,
-                                          marker=ipyleaflet.Marker()))
-        self.add(ipyleaflet.ScaleControl(position="bottomleft", max_width=200, imperial=False))
-        
         wms_layers = kwargs.get("wms_layers", BASE_WMS)
-        self._add_wms(wms_layers)
+        # overlays by name for constant time lookups (WMSComponent), kept in sync with the layers
+        self._named_overlays = {}
+        self.observe(self._prune_named_overlays, names="layers")
+
+        # the controls and the wms widget are synced to the frontend in a single update
+        with self.hold_sync():
+            self.controls = self.controls + tuple(self._create_map_control(name) for name in map_controls)
+            self._add_wms(wms_layers)
         
+    def _create_map_control(self, name: str) -> ipyleaflet.Control:
+        if name == "draw":
+            return self.map_draw_control
+        if name == "layers":
+            return ipyleaflet.LayersControl(position="topright")
+        if name == "fullscreen":
+            return ipyleaflet.FullScreenControl(position="topleft")
+        if name == "search":
+            return ipyleaflet.SearchControl(url="https://nominatim.openstreetmap.org/search?format=json&q={s}",
+                                            zoom=17,
+                                            marker=ipyleaflet.Marker())
+        if name == "scale":
+            return ipyleaflet.ScaleControl(position="bottomleft", max_width=200, imperial=False)
+        raise ValueError(f"unknown map control {name}, should be one of {MAP_CONTROLS}")
+
+    def add_map_control(self, name: str) -> None:
+        """
+        Add one of the MAP_CONTROLS that was left out when the map was created
+        """
+        self.add(self._create_map_control(name))
+
     def setup_draw_control(self) -> ipyleaflet.DrawControl:
         map_draw_control = ipyleaflet.DrawControl(
         polyline={"shapeOptions": {"color": self.color_polyline}},
@@ -57,6 +95,11 @@ class Map(ipyleaflet.Map):
         return map_draw_control
         
 
+    def _prune_named_overlays(self, change):
+        if len(self._named_overlays) > 0:
+            layers = set(map(id, change["new"]))
+            self._named_overlays = {name: layer for name, layer in self._named_overlays.items() if id(layer) in layers}
+
     def clear_drawings(self):
         self.map_draw_control.clear_polylines()
         self.map_draw_control.clear_polygons()
@@ -69,43 +112,37 @@ class Map(ipyleaflet.Map):
 
     def get_polylines(self):
         data = self.map_draw_control.data
-        lines = [LineString(xx['geometry']["coordinates"]) for xx in data if xx['geometry']["type"] == 'LineString']
-        return lines
+        line_coords = [xx['geometry']["coordinates"] for xx in data if xx['geometry']["type"] == 'LineString']
+        if len(line_coords) == 0:
+            return []
+        # all the drawn lines are built in one vectorized call from the stacked coordinates
+        counts = [len(coords) for coords in line_coords]
+        lines = shapely.linestrings(np.concatenate(line_coords), 
+                                    indices=np.repeat(np.arange(len(line_coords)), counts))
+        return lines.tolist()
 
 
     def get_polygons(self):
         data = self.map_draw_control.data
-        polygons = [Polygon(np.squeeze(xx['geometry']["coordinates"])) for xx in data if xx['geometry']["type"] == 'Polygon']
-        return polygons
+        polygon_coords = [xx['geometry']["coordinates"] for xx in data if xx['geometry']["type"] == 'Polygon']
+        if len(polygon_coords) == 0:
+            return []
+        # every ring of every polygon is built in one call, the first ring of each polygon is its shell
+        # and the others its holes
+        ring_coords = [ring for coords in polygon_coords for ring in coords]
+        rings = shapely.linearrings(np.concatenate(ring_coords), 
+                                    indices=np.repeat(np.arange(len(ring_coords)), [len(ring) for ring in ring_coords]))
+        polygons = shapely.polygons(rings, indices=np.repeat(np.arange(len(polygon_coords)), 
+                                                             [len(coords) for coords in polygon_coords]))
+        return polygons.tolist()
     
 
     @staticmethod
     def basemap_layers() -> list:
         """
-        Returns the basemap layers
+        Returns the basemap layers, new TileLayers from the BASEMAPS specs (each map needs its own widget models)
         """
-        gcbilder = ipyleaflet.TileLayer(
-            url="https://services.geodataonline.no/arcgis/rest/services/Geocache_WMAS_WGS84/"
-                "GeocacheBilder/MapServer/tile/{z}/{y}/{x}",
-            name="Bilde", attribution="Geodata AS")
-        gcbilder.base = True
-
-        basis = ipyleaflet.TileLayer(
-            url="https://services.geodataonline.no/arcgis/rest/services/Geocache_WMAS_WGS84/"
-                "GeocacheBasis/MapServer/tile/{z}/{y}/{x}",
-            attribution="Geodata AS", name="Basis", format="image/png")
-        basis.base = True
-
-        osm = ipyleaflet.TileLayer(url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png", attribution="OpenStreetMap",
-                        name="OpenStreetMap", )
-        osm.base = True
-
-        hillshade = ipyleaflet.TileLayer(url="https://services.geodataonline.no/arcgis/rest/services/Geocache_WMAS_WGS84/"
-                            "GeocacheTerrengskygge/MapServer/tile/{z}/{y}/{x}",
-                            attribution="Geodata AS", name="Terrengskygge", format="image/png")
-        hillshade.base = True
-
-        return [osm, gcbilder, basis]
+        return [ipyleaflet.TileLayer(**spec, base=True) for spec in BASEMAPS]
     
 
     def show(self, height: int = 600) -> None:
@@ -1,25 +1,53 @@
 import numpy as np
 import rasterio
+import shapely
+from functools import lru_cache
 import geopandas as gpd
 import pandas as pd
-from rasterio import MemoryFile
 from shapely.geometry import LineString, MultiLineString
 import plotly.graph_objects as go
+from pyproj import Transformer
 
 from core_components.logger import setup_logger
 from core_components.config import get_config
-from core_components.api.hoydedata_api import request_hoydedata
+from core_components.api.hoydedata_api import request_hoydedata, sample_points_from_hoydedata
 
 
 logger = setup_logger(__name__)
 
 cfg = get_config()
 
-HOYDEDATA_LAYER = cfg["hoydedata"]["hoydedata_layer"]
-HOYDEDATA_URL = cfg["hoydedata"]["hoydedata_url"]
 CRS = cfg["global"]["crs_default"] # default crs
 
 
+@lru_cache(maxsize=16)
+def _get_transformer(crs_from, crs_to=CRS) -> Transformer:
+    """
+    Cached transformer between two crs, building a pyproj pipeline is expensive compared to using it
+    """
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
+def _geometry_to_crs(geometry, crs):
+    """
+    Transform a single shapely geometry from crs to CRS, without going through a GeoDataFrame
+    """
+    transformer = _get_transformer(crs)
+    return shapely.transform(geometry, lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
+
+
+def _terrain_envelope(m: np.ndarray, z: np.ndarray, limit: float) -> np.ndarray:
+    """
+    Lower envelope of the lines z_i + |m - m_i| / limit from every point i, for m sorted ascending.
+    The points to the left of each m give min_i<=j(z_i - m_i / limit) + m_j / limit and the points to the
+    right min_i>=j(z_i + m_i / limit) - m_j / limit, two running minimums, so it is O(n) instead of O(n^2).
+    """
+    slope = m / limit
+    left = np.minimum.accumulate(z - slope) + slope
+    right = np.minimum.accumulate((z + slope)[::-1])[::-1] - slope
+    return np.minimum(left, right)
+
+
 class Profile:
     """
     The Profile class represents a topographic profile from a line, using Høydedata as source.
@@ -52,12 +80,12 @@ class Profile:
             line_gdf = line.to_crs(CRS)
 
         elif isinstance(line, LineString) or isinstance(line, MultiLineString):
-            line_gdf = gpd.GeoDataFrame(geometry=[line], crs=crs).to_crs(CRS)
+            line_gdf = gpd.GeoDataFrame(geometry=[_geometry_to_crs(line, crs)], crs=CRS)
 
         elif isinstance(line, np.ndarray):
             if line.shape[1] != 2:
                 raise ValueError("if line is array shape should be (n,2)")
-            line_gdf = gpd.GeoDataFrame(geometry=[LineString(line)], crs=crs).to_crs(CRS)
+            line_gdf = gpd.GeoDataFrame(geometry=[_geometry_to_crs(LineString(line), crs)], crs=CRS)
 
         else:
             print(type(line))
@@ -66,7 +94,7 @@ class Profile:
         self.line = line_gdf
 
         self._interpolate(dist=5, min_points=5)
-        self.points_coords = self.line.get_coordinates().values
+        self.points_coords = shapely.get_coordinates(self.line.geometry.values)
 
         self.profile = self._profile()
 
@@ -89,8 +117,8 @@ class Profile:
         line_geometry = self.line.iloc[0].geometry
         n_points = int(max(line_geometry.length // dist, min_points))
 
-        new_points = [line_geometry.interpolate(i / float(n_points - 1), normalized=True) for i in range(n_points)]
-        points_coords = np.array([[pp.coords.xy[0][0], pp.coords.xy[1][0]] for pp in new_points])
+        new_points = shapely.line_interpolate_point(line_geometry, np.arange(n_points) / (n_points - 1), normalized=True)
+        points_coords = shapely.get_coordinates(new_points)
 
         self.line['geometry'] = LineString(points_coords)
 
@@ -100,22 +128,18 @@ class Profile:
         Retrieves elevation data for the given points.
 
         Returns:
-            list: A list of elevation values corresponding to the given points.
+            np.ndarray: The elevation values corresponding to the given points (NaN if the DEM could not be read).
         """
 
         tif_bytes = request_hoydedata(tuple(self.line.total_bounds))
 
-        z_dem = []
         try:
-            with MemoryFile(tif_bytes) as memfile:
-                with memfile.open() as dataset:
-                    dem_array = dataset.read(1)
-                    for pp in self.points_coords:
-                        ind = dataset.index(pp[0], pp[1])
-                        z_dem.append(dem_array[ind[0], ind[1]])
+            z_dem = sample_points_from_hoydedata(tif_bytes, self.points_coords)
 
         except rasterio.errors.RasterioIOError as e:
-            print("feil: ", e)
+            logger.warning(f"Could not read the DEM for the profile: {e}")
+            # preallocated missing values, so the profile keeps one row per point
+            z_dem = np.full(len(self.points_coords), np.nan)
 
         return z_dem
 
@@ -134,13 +158,14 @@ class Profile:
 
         z_dem = self._get_hoydedata()
 
-        cum_dist = np.cumsum(
-            np.sqrt(np.sum((np.r_[[[0, 0]], np.diff(self.points_coords, axis=0)[:, :2]]) ** 2, axis=1)))
+        segment_lengths = np.linalg.norm(np.diff(self.points_coords[:, :2], axis=0), axis=1)
+        cum_dist = np.concatenate(([0.0], np.cumsum(segment_lengths)))
 
-        self.profile = pd.DataFrame({'x': self.points_coords[:, 0],
-                                     'y': self.points_coords[:, 1],
-                                     'z': z_dem,
-                                     'm': cum_dist})
+        self.profile = pd.DataFrame(np.column_stack((self.points_coords[:, :2], z_dem, cum_dist)),
+                                    columns=['x', 'y', 'z', 'm'])
+        # array views of the columns for the numeric and plotting code
+        self._m = self.profile['m'].to_numpy()
+        self._z = self.profile['z'].to_numpy()
 
         return self.profile
 
@@ -156,20 +181,19 @@ class Profile:
             GeoDataFrame: A tuple containing the projected points DataFrame.
 
         """
-        out_gdf = points_df.copy()
-        out_gdf = out_gdf.to_crs(CRS)
+        # to_crs returns a new frame (and skips the transform when the crs already matches), no extra copy needed
+        out_gdf = points_df.to_crs(CRS)
 
         profile_xy = self.points_coords
 
-        bh_coordinates = out_gdf.get_coordinates(include_z=True)
-
-        def distance(xy): return np.sqrt((bh_coordinates.x.values -
-                                          xy[0]) ** 2 + (bh_coordinates.y.values - xy[1]) ** 2)
+        bh_xy = shapely.get_coordinates(out_gdf.geometry.values)
 
-        dists = np.array([distance(p_xy) for p_xy in profile_xy])
+        # squared distances (profile points x points) in one broadcast, the sqrt is only taken of the minimum
+        diff = profile_xy[:, None, :2] - bh_xy[None, :, :]
+        sq_dists = np.einsum('ijk,ijk->ij', diff, diff)
 
-        min_dist = np.min(dists, axis=0)  # minimum distance
-        i_pt_min = np.argmin(dists, axis=0)  # index of point at minimum distance
+        i_pt_min = np.argmin(sq_dists, axis=0)  # index of point at minimum distance
+        min_dist = np.sqrt(sq_dists[i_pt_min, np.arange(len(bh_xy))])  # minimum distance
         point_data_profile = self.profile.loc[i_pt_min, :]  # profile data of point at minimum distance
 
         point_data_profile['dist_profile'] = min_dist
@@ -197,8 +221,8 @@ class Profile:
             two tuples with m,z values for both the line and the local minima of the profile
         """
         # from scipy.signal import argrelextrema
-        z = self.profile.z
-        m = self.profile.m
+        z = self._z
+        m = self._m
         length = m.max()-m.min() #self.line.length.sum()
 
         num_points = int(max(length//res, 10))
@@ -217,20 +241,12 @@ class Profile:
         # local_mins_list_m = [m_interp[ll] for ll in local_mins]
         # local_mins_list_z = [z_interp[ll] for ll in local_mins]
 
-        lines = []
-        local_mins = range(len(m_interp))
         local_mins_list_m = m_interp
         local_mins_list_z = z_interp
 
-        for i_min in local_mins:
-            z_min = z_interp[i_min]
-            m_0 = m_interp[i_min]
-            m_line = np.abs(m_interp - m_0)
-            z_line = m_line / limit
-            lines.append(z_min + z_line - depth)
+        z_line_out = _terrain_envelope(m_interp, z_interp, limit) - depth
 
-        z_line_out = np.min(lines, axis=0)
-        z_line_out[z_line_out > z_interp] = z_interp[z_line_out > z_interp]
+        np.minimum(z_line_out, z_interp, out=z_line_out)
 
         return (m_interp, z_line_out), (local_mins_list_m, local_mins_list_z)
 
@@ -284,9 +300,7 @@ class ProfileFigure:
             profile_length = round(profile.line.length.iloc[-1], 1)
             graph_width = max(int(profile_length * 4), 500) if width is None else width
 
-            line_coords = profile.line.get_coordinates()
-            x0, y0 = line_coords.iloc[0].values
-            x1, y1 = line_coords.iloc[1].values
+            (x0, y0), (x1, y1) = profile.points_coords[:2]
             fig_title = f"Profile @ ({x0:.1f}, {y0:.1f}), ({x1:.1f}, {y1:.1f})"
 
             layout = go.Layout(
@@ -296,8 +310,12 @@ class ProfileFigure:
                 dragmode='pan',
                 width=graph_width,
                 height=height,
-   
+                xaxis=dict(scaleanchor="y", scaleratio=1) if equal_axis_xy else None,
             )
+        elif equal_axis_xy:
+            # merged into a copy, the caller's layout and its other xaxis settings are kept
+            layout = go.Layout(layout)
+            layout.update(xaxis=dict(scaleanchor="y", scaleratio=1))
 
         fig = go.FigureWidget(layout=layout) if as_widget else go.Figure(layout=layout)
         fig._config = fig._config | {'scrollZoom': True}
@@ -308,12 +326,9 @@ class ProfileFigure:
 
         self.profile = profile
 
-        self.min_depth = (profile.profile.z.min() * 0.9 // 10) * 10
+        self.min_depth = (profile._z.min() * 0.9 // 10) * 10
         self._add_profile_trace()
         self._add_bottom_trace()
-        
-        if equal_axis_xy:
-            self.figure.update_layout(xaxis=dict(scaleanchor="y", scaleratio=1))
            
 
     def show(self) -> None:
@@ -329,7 +344,7 @@ class ProfileFigure:
         Adds a trace of the terrain profile to the figure.
         """
         self.figure.add_trace(
-            go.Scatter(x=self.profile.profile.m, y=self.profile.profile.z, mode="lines",
+            go.Scatter(x=self.profile._m, y=self.profile._z, mode="lines",
                        name="terrain surface",
                        line=dict(color="saddlebrown", width=2),
                        showlegend=False)
@@ -341,7 +356,7 @@ class ProfileFigure:
         Adds a trace of the terrain bottom to the figure.
         """
         self.figure.add_trace(
-            go.Scatter(x=self.profile.profile.m, y=np.ones_like(self.profile.profile.m) * self.min_depth,
+            go.Scatter(x=self.profile._m, y=np.full_like(self.profile._m, self.min_depth),
                        name="terrain bottom",
                        mode="lines", fill="tonexty", fillcolor="rgba(110, 80, 50, 0.9)",
                        line=dict(color="saddlebrown", width=2),
@@ -394,7 +409,6 @@ class ProfileFigure:
 
         line = self.profile.line
         bounds = tuple(np.round(line.buffer(buffer_distance).total_bounds))
-        print(bounds)
         buildings = get_building_points(bounds)
         buildings = self.profile.project_points_in_profile(buildings).query("dist_profile<50").copy()
         
@@ -402,9 +416,9 @@ class ProfileFigure:
             return
 
         if use_actual_elevation:
-            elevations = get_z_from_hoydedata(buildings.get_coordinates().values)
+            elevations = get_z_from_hoydedata(shapely.get_coordinates(buildings.geometry.values))
         else:
-            elevations = self.profile.profile.loc[buildings.iloc_profile, "z"]+1
+            elevations = self.profile._z[buildings.iloc_profile.to_numpy()]+1
 
         self.figure.add_trace(
             go.Scatter(
@@ -3,22 +3,52 @@ config = {
         'crs_map': 4326,
         'crs_default': 25833
     },
+    'http': {
+        'pool_connections': 16,
+        'pool_maxsize': 32,
+        'max_retries': 5,
+        'backoff_factor': 0.5,
+        'status_forcelist': [429, 500, 502, 503, 504],
+        'connect_timeout': 5,
+        'read_timeout': 30
+    },
     'hoydedata': {
         'hoydedata_layer': "NHM_DTM_25833",
+        'max_workers': 8,
+        'cache_dir': "~/.cache/core_components/hoydedata",
+        'cache_size': 8,
+        # points per pixel below which windowed reads are used, measured break-even ~3e-5 on 1000-3000 px tiles
+        'sample_density_threshold': 2e-5,
+        'cache_expire': 86400,  # seconds
+        'cache_max_files': 256,  # tiles kept on disk, the oldest are removed first
         'hoydedata_url': "https://hoydedata.no/arcgis/rest/services/{}/ImageServer/exportImage?bbox={},{},{},{}&size={},{}&bboxSR=&size=&imageSR=&time=&format=tiff&pixelType=F32&noData={}&noDataInterpretation=esriNoDataMatchAny&interpolation=+RSP_BilinearInterpolation&compression=&compressionQuality=&bandIds=&mosaicRule=&renderingRule=&f=image"
     },
     'buildings': {
         'url': "https://wfs.geonorge.no/skwms1/wfs.matrikkelen-bygningspunkt",
         'columns': ['bygningsnummer', 'bygningsstatus', 'kommunenavn', 'bygningstype', 'bygningId', 'geometry'],
-        'query_filter': "bygningsstatus not in ('GR', 'IP', 'BR', 'BF', 'IG')"
+        'query_filter': "bygningsstatus not in ('GR', 'IP', 'BR', 'BF', 'IG')",
+        'output_formats': ["application/flatgeobuf", "application/json", "application/gml+xml; version=3.2"]
     },
     'consequence': {
         'url': "https://gis3.nve.no/arcgis/rest/services/geoprocessing/Konsekevens1/GPServer/KonskvensParametere1",
-        'items': ["Beboere","Barn","Ansatte","Bygninger","Kraftlinjer","Toglinjer"]
+        'items': ["Beboere","Barn","Ansatte","Bygninger","Kraftlinjer","Toglinjer"],
+        'poll_initial_wait': 1,
+        'poll_max_wait': 30,
+        'poll_timeout': 900
     },
     'nadag': {
         'url': "https://ogcapitest.ngu.no/rest/services/grunnundersokelser_utvidet/collections",
         'timeout': 300,
+        'max_connections': 64,
+        'max_keepalive_connections': 32,
+        'keepalive_expiry': 30,  # seconds an idle connection is kept open
+        'connect_retries': 3,
+        'max_concurrent_requests': 32,  # in flight per get_href_list call
+        'max_concurrency': 8,  # sub-areas fetched at the same time in get_data_big_areas
+        'cache_dir': "~/.cache/core_components/nadag",
+        'cache_expire': 86400,  # seconds
+        'cache_size': 256,  # in-memory entries
+        'cache_max_files': 20000,  # responses kept on disk, the oldest are removed first
         'column_mapper_borehole': {
             'anvendtlast': 'penetration_force', 
             'boretlengde': 'depth', 
@@ -2,12 +2,18 @@ import logging
 from datetime import datetime
 from pathlib import Path
 
+# resolved once at import, the loggers are cached by name and log file so repeated calls
+# (every module calls setup_logger at import) do not reopen the log file
+_LOG_DIR = Path('../.logs') if Path.cwd().name in ("notebooks", ".notebooks") else Path('.logs')
+_cached = {}
+
 def setup_logger(name='root', log_file=None):
-    current_dir = Path.cwd()
-    log_dir = Path('../.logs') if current_dir.name in ("notebooks", ".notebooks") else Path('.logs')
-    
-    if not log_dir.exists():
-        log_dir.mkdir(parents=True)
+    key = (name, log_file)
+    if key in _cached:
+        return _cached[key]
+
+    log_dir = _LOG_DIR
+    log_dir.mkdir(parents=True, exist_ok=True)
 
     log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
@@ -27,4 +33,5 @@ def setup_logger(name='root', log_file=None):
 
     logger.propagate = False
 
+    _cached[key] = logger
     return logger
\ No newline at end of file
@@ -1,5 +1,6 @@
 import geopandas as gpd
-from shapely.geometry import box
+import numpy as np
+import shapely
 
 def split_bbox(bbox:gpd.GeoDataFrame, n_rows:int, n_cols:int) -> list[gpd.GeoDataFrame]:
     """
@@ -8,14 +9,11 @@ def split_bbox(bbox:gpd.GeoDataFrame, n_rows:int, n_cols:int) -> list[gpd.GeoDat
     minx, miny, maxx, maxy = bbox.total_bounds
     width = (maxx - minx) / n_cols
     height = (maxy - miny) / n_rows
-    sub_boxes = []
-    for i in range(n_cols):
-        for j in range(n_rows):
-            sub_minx = minx + i * width
-            sub_miny = miny + j * height
-            sub_maxx = sub_minx + width
-            sub_maxy = sub_miny + height
-            sub_boxes.append(box(sub_minx, sub_miny, sub_maxx, sub_maxy))
+    # all the sub boxes at once, column by column as (i, j) with i over the columns and j over the rows
+    i, j = np.meshgrid(np.arange(n_cols), np.arange(n_rows), indexing="ij")
+    sub_minx = (minx + i * width).ravel()
+    sub_miny = (miny + j * height).ravel()
+    sub_boxes = shapely.box(sub_minx, sub_miny, sub_minx + width, sub_miny + height)
     subgrid = gpd.GeoDataFrame(geometry=sub_boxes, crs = bbox.crs)
     subgrid["id"] = range(len(subgrid))
     return subgrid
\ No newline at end of file
@@ -0,0 +1,72 @@
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+from core_components.api import buildings_api
+
+
+class FakeResponse:
+    def __init__(self, content: bytes, status_code: int = 200):
+        self.content = content
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_content(self, chunk_size):
+        for ii in range(0, len(self.content), chunk_size):
+            yield self.content[ii:ii + chunk_size]
+
+
+@pytest.fixture
+def buildings(tmp_path):
+    gdf = gpd.GeoDataFrame({"bygningsnummer": [1, 2], "bygningsstatus": ["TB", "BR"], "kommunenavn": ["a", "b"],
+                            "bygningstype": [111, 111], "bygningId": [10, 20]},
+                           geometry=[Point(1, 2), Point(3, 4)], crs=25833)
+    gdf.to_file(tmp_path / "buildings.fgb", driver="FlatGeobuf")
+    return {"application/flatgeobuf": (tmp_path / "buildings.fgb").read_bytes(),
+            "application/json": gdf.to_json().encode()}
+
+
+class FakeWFS:
+    def __init__(self, buildings: dict):
+        self.buildings = buildings
+        self.rejected = set()
+        self.requested_formats = []
+
+    def get(self, url, params, stream, timeout):
+        self.requested_formats.append(params["outputFormat"])
+        if params["outputFormat"] in self.rejected:
+            return FakeResponse(b"<ows:ExceptionReport/>")
+        return FakeResponse(self.buildings[params["outputFormat"]])
+
+
+@pytest.fixture
+def wfs(monkeypatch, buildings):
+    wfs = FakeWFS(buildings)
+    monkeypatch.setattr(buildings_api.SESSION, "get", wfs.get)
+    monkeypatch.setattr(buildings_api, "_OUTPUT_FORMAT", None)
+    return wfs
+
+
+def test_get_building_points_flatgeobuf(wfs):
+    dataset = buildings_api.get_building_points((0, 0, 10, 10))
+    assert dataset["bygningsnummer"].tolist() == [1]
+    assert wfs.requested_formats == ["application/flatgeobuf"]
+
+
+def test_get_building_points_falls_back_on_exception_report(wfs):
+    wfs.rejected.add("application/flatgeobuf")
+    dataset = buildings_api.get_building_points((0, 0, 10, 10))
+    assert dataset["bygningsnummer"].tolist() == [1]
+    assert wfs.requested_formats == ["application/flatgeobuf", "application/json"]
+
+
+def test_get_building_points_remembers_the_accepted_format(wfs):
+    wfs.rejected.add("application/flatgeobuf")
+    buildings_api.get_building_points((0, 0, 10, 10))
+    buildings_api.get_building_points((0, 0, 10, 10))
+    assert wfs.requested_formats == ["application/flatgeobuf", "application/json", "application/json"]
@@ -0,0 +1,18 @@
+from core_components.api import consequence_api
+
+
+def test_fix_encoding_only_repairs_avviksmelding():
+    mojibake = "Ingen bygg i området".encode("utf-8").decode("latin1")
+    results = {"Beboere": {"Antall": 3, "Avviksmelding": mojibake, "Navn": "Ã…se"},
+               "Avviksmelding": "Ingen"}
+    assert consequence_api._fix_encoding(results) == {
+        "Beboere": {"Antall": 3, "Avviksmelding": "Ingen bygg i området", "Navn": "Ã…se"},
+        "Avviksmelding": "Ingen"}
+
+
+def test_generate_html_joins_the_report_lines():
+    results = {"Beboere": {"Antall": 3, "Avviksmelding": "Ingen"}, "Avviksmelding": "Ingen"}
+    html = consequence_api.generate_html(results)
+    assert html == "\n".join(consequence_api.report_consequence_html(results))
+    assert html.startswith(consequence_api.HTML_HEADER)
+    assert not html.endswith("\n")
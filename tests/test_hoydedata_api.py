@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+from core_components.api import hoydedata_api
+
+
+@pytest.fixture
+def tif_bytes():
+    dem = np.arange(200 * 300, dtype="float32").reshape(200, 300)
+    with MemoryFile() as memfile:
+        with memfile.open(driver="GTiff", width=300, height=200, count=1, dtype="float32",
+                          transform=from_origin(1000, 2000, 5, 5), crs="EPSG:25833") as dataset:
+            dataset.write(dem, 1)
+        return memfile.read()
+
+
+def test_rowcol_from_transform():
+    rows, cols = hoydedata_api.rowcol_from_transform(from_origin(1000, 2000, 5, 5),
+                                                     np.array([1000.0, 1004.9, 1012.5]),
+                                                     np.array([2000.0, 1995.0, 1987.4]))
+    np.testing.assert_array_equal(rows, [0, 1, 2])
+    np.testing.assert_array_equal(cols, [0, 0, 2])
+
+
+@pytest.mark.parametrize("threshold", [0, 1])
+def test_sample_points_windowed_and_full_read_agree(tif_bytes, monkeypatch, threshold):
+    # threshold 0 always reads the full raster, 1 always uses windowed reads
+    monkeypatch.setattr(hoydedata_api, "SAMPLE_DENSITY_THRESHOLD", threshold)
+    points_xy = np.array([[1000.1, 1999.9], [1752.5, 1502.5], [2499.9, 1000.1]])
+    z = hoydedata_api.sample_points_from_hoydedata(tif_bytes, points_xy)
+    np.testing.assert_array_equal(z, [0, 99 * 300 + 150, 199 * 300 + 299])
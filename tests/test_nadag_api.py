@@ -0,0 +1,176 @@
+import asyncio
+import importlib
+import os
+import time
+
+import geopandas as gpd
+import httpx
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+
+def nadag_api_module():
+    return importlib.import_module("core_components.api.nadag_api")
+
+
+@pytest.fixture
+def nadag_api(monkeypatch, tmp_path):
+    monkeypatch.setenv("NADAG_OFFLINE", "1")
+    module = nadag_api_module()
+    monkeypatch.setattr(module, "CACHE_DIR", tmp_path)
+    monkeypatch.setattr(module, "_HREF_CACHE", {})
+    module.get_api_data.cache_clear()
+    yield module
+    module.get_api_data.cache_clear()
+
+
+def _get_href_list(nadag_api, hrefs, handler):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await nadag_api.get_href_list(hrefs, client)
+    return asyncio.run(run())
+
+
+def test_valid_collections_and_crs_offline(nadag_api):
+    assert "geotekniskborehullunders" in nadag_api.valid_collections
+    assert 25833 in nadag_api.valid_crs
+    with pytest.raises(AttributeError):
+        nadag_api.not_an_attribute
+
+
+def test_api_meta_round_trip(nadag_api):
+    nadag_api._write_api_meta(b'{"collections": [{"id": "a"}], "crs": ["http://x/EPSG/0/25833"]}')
+    assert nadag_api._read_api_meta() == {"collections": [{"id": "a"}], "crs": ["http://x/EPSG/0/25833"]}
+
+
+def test_incomplete_api_meta_is_ignored(nadag_api):
+    nadag_api._write_api_meta(b"{}")
+    assert nadag_api._read_api_meta() is None
+    assert 25833 in nadag_api.valid_crs
+
+
+def test_get_href_list_skips_failed_pages_and_does_not_cache_them(nadag_api):
+    def handler(request):
+        if request.url.path == "/down":
+            return httpx.Response(503, json={"error": "down"})
+        return httpx.Response(200, json={"path": request.url.path})
+
+    data = _get_href_list(nadag_api, ["http://nadag/a", "http://nadag/down", None, "http://nadag/a"], handler)
+    assert data == [{"path": "/a"}, None, None, {"path": "/a"}]
+    assert list(nadag_api._HREF_CACHE) == ["http://nadag/a"]
+    assert nadag_api._cache_file("http://nadag/down").exists() is False
+
+
+def test_cache_prune(nadag_api, monkeypatch, tmp_path):
+    monkeypatch.setattr(nadag_api, "CACHE_MAX_FILES", 2)
+    now = time.time()
+    for ii, age in enumerate([10, 20, 30, 2 * nadag_api.CACHE_EXPIRE]):
+        cache_file = tmp_path / f"{ii}.json"
+        cache_file.write_bytes(b"{}")
+        os.utime(cache_file, (now - age, now - age))
+
+    nadag_api._cache_prune()
+    assert sorted(cache_file.name for cache_file in tmp_path.iterdir()) == ["0.json", "1.json"]
+
+
+def test_create_flagged_column():
+    df = pd.DataFrame({"start": [False, True, False, False, True, True, False, False],
+                       "end":   [False, False, False, True, False, False, True, False]},
+                      index=list("abcdefgh"))
+    flags = nadag_api_module().create_flagged_column(df, "start", "end")
+    pd.testing.assert_series_equal(
+        flags, pd.Series([False, True, True, False, True, True, False, False], index=df.index))
+
+
+@pytest.mark.parametrize("starts, ends, groups, expected", [
+    # an end on the same row as a start wins
+    ([0, 1, 0, 0], [0, 1, 0, 0], None, [0, 0, 0, 0]),
+    # an end before any start does not delay a later start
+    ([0, 0, 1, 0], [1, 0, 0, 0], None, [0, 0, 1, 1]),
+    # repeated starts are closed by a single end
+    ([1, 1, 0, 0], [0, 0, 1, 0], None, [1, 1, 0, 0]),
+    # the flag is reset at the first row of each sounding
+    ([1, 0, 0, 0, 1], [0, 0, 0, 0, 0], [0, 0, 1, 1, 2], [1, 1, 0, 0, 1]),
+])
+def test_flag_intervals(starts, ends, groups, expected):
+    flags = nadag_api_module()._flag_intervals(np.array(starts, dtype=bool), np.array(ends, dtype=bool),
+                                               None if groups is None else np.array(groups))
+    np.testing.assert_array_equal(flags, np.array(expected, dtype=bool))
+
+
+def test_get_sample_depth():
+    depth_top = np.array([1.0, 2.0, 3.0, 4.0, np.nan])
+    depth_base = np.array([2.0, np.nan, 0.0, 4.0, 1.0])
+    np.testing.assert_array_equal(nadag_api_module()._get_sample_depth(depth_top, depth_base),
+                                  [1.5, 2.0, 3.0, 4.0, np.nan])
+
+
+def test_create_intervals_from_comments_does_not_modify_input(nadag_api):
+    df = pd.DataFrame({"comment_code": [None, 11, "15", None], "depth": [1.0, 2.0, 3.0, 4.0]})
+    expected = df.copy()
+    flags = nadag_api.create_intervals_from_comments(df)
+    pd.testing.assert_frame_equal(df, expected)
+    assert flags.columns.tolist() == ["hammering", "increased_rotation_rate", "flushing"]
+
+
+def test_get_all_soundings_does_not_modify_input(nadag_api, monkeypatch):
+    gbhu = gpd.GeoDataFrame({"identifikasjon": [{"lokalId": "a"}, {"lokalId": "b"}],
+                             "metode-StatiskSondering": [[{"href": "s1"}], None],
+                             "metode-KombinasjonSondering": [None, [{"href": "k1"}]],
+                             "høyde": [10.0, 20.0],
+                             "undersPkt": [{"href": "ua"}, {"href": "ub"}]},
+                            geometry=[Point(1, 2), Point(3, 4)], crs=25833)
+    expected = gbhu.copy()
+
+    async def get_href_list(hrefs, client=None, bypass_cache=False):
+        pages = []
+        for href in hrefs:
+            if href in ("s1", "k1"):
+                soundings_type = {"s1": "statiskSondering", "k1": "kombinasjonSondering"}[href]
+                pages.append({"properties": {f"{soundings_type}Observasjon": {"href": "o" + href}}})
+            elif href.startswith("o"):
+                pages.append({"features": [{"properties": {"boretLengde": depth, "observasjonKode": None}}
+                                           for depth in (1.0, 2.0)]})
+            else:
+                pages.append({"properties": {"boreNr": href}})
+        return pages
+
+    monkeypatch.setattr(nadag_api, "get_href_list", get_href_list)
+    boreholes = asyncio.run(nadag_api.get_all_soundings(gbhu))
+    pd.testing.assert_frame_equal(gbhu, expected)
+    assert boreholes["location_name"].tolist() == ["ua", "ub"]
+
+
+def test_get_samples_does_not_modify_input(nadag_api, monkeypatch):
+    gbhu = gpd.GeoDataFrame({"identifikasjon": [{"lokalId": "g1"}, {"lokalId": "g2"}],
+                             "metode-GeotekniskPrøveserie": [[{"href": "ps1"}], [{"href": "ps2"}]],
+                             "høyde": [10.0, 20.0],
+                             "undersPkt": [{"href": "u1"}, {"href": "u2"}]},
+                            geometry=[Point(1, 2), Point(3, 4)], crs=25833)
+    expected = gbhu.copy()
+
+    async def get_href_list(hrefs, client=None, bypass_cache=False):
+        pages = []
+        for href in hrefs:
+            if href.startswith("u"):
+                pages.append({"properties": {"boreNr": "B" + href}})
+            elif href.startswith("psd"):
+                pages.append({"features": [{"properties": {
+                    "prøveseriedelId": f"D{href[3]}", "tilhørerPrøveserie": {"title": f"P{href[3]}"},
+                    "fraLengde": 1.0, "tilLengde": 2.0, "harData": {"href": f"dat{href[3]}"}}}]})
+            elif href.startswith("ps"):
+                pages.append({"features": [{"properties": {
+                    "identifikasjon": {"lokalId": f"P{href[2]}"}, "geotekniskborehullunders": f"g{href[2]}",
+                    "harPrøveseriedel": {"href": f"psd{href[2]}"}}}]})
+            else:
+                pages.append({"features": [{"properties": {
+                    "tilhørerPrøveseriedel": {"title": f"D{href[3]}"}, "vanninnhold": 30.0,
+                    "detaljertLagSammensetning": "Leire, kvikk"}}]})
+        return pages
+
+    monkeypatch.setattr(nadag_api, "get_href_list", get_href_list)
+    samples = asyncio.run(nadag_api.get_samples(gbhu, aggregate=False))
+    pd.testing.assert_frame_equal(gbhu, expected)
+    assert len(samples) == 2